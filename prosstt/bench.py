@@ -0,0 +1,592 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+This module contains benchmarks for the performance critical parts of PROSSTT.
+Run them from the command line with::
+
+    python -m prosstt.bench
+
+The benchmark suite times every hot path for all combinations of the given
+numbers of cells, genes and tree depths with fixed seeds, and can write the
+results as JSON so that they can be compared across commits::
+
+    python -m prosstt.bench --cells 1000 10000 --genes 100 1000 --depth 1 3 \\
+        --json results.json
+
+The memory benchmark traces the peak memory of every stage of a simulation
+and fails if a stage exceeds its bound::
+
+    python -m prosstt.bench --memory
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import scipy as sp
+
+from prosstt import count_model as cm
+from prosstt import instrumentation as ins
+from prosstt import scoring as sc
+from prosstt import sim_utils as sut
+from prosstt import simulation as sim
+from prosstt import tree as tr
+
+# the pseudotime length of every branch of the benchmark trees
+BRANCH_TIME = 40
+
+
+def _best_time(func, repeat):
+    """
+    Run func repeat times and return the fastest wall time in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_negbin(size=10**7, repeat=3, seed=0):
+    """
+    Compare drawing negative binomial counts through scipy.stats.nbinom with
+    the gamma-Poisson sampler of count_model.
+
+    Parameters
+    ----------
+    size: int, optional
+        The number of counts to draw
+    repeat: int, optional
+        How many times each sampler is timed; the fastest run is reported
+    seed: int, optional
+        Seed for the mean expression values and the samplers
+
+    Returns
+    -------
+    results: dict
+        Wall times in seconds for both samplers and the resulting speedup
+    """
+    rng = np.random.default_rng(seed)
+    means = np.exp(rng.standard_normal(size))
+    p, r = cm.get_pr_umi(a=0.2, b=2., m=means)
+    del means
+
+    scipy_time = _best_time(lambda: sp.stats.nbinom(n=r, p=1 - p).rvs(), repeat)
+    gp_time = _best_time(lambda: cm.sample_negbin(p, r, rng), repeat)
+    return {"size": size,
+            "scipy_nbinom": scipy_time,
+            "sample_negbin": gp_time,
+            "speedup": scipy_time / gp_time}
+
+
+def bench_count_workers(cells=20000, genes=2000, workers=(1, 2, 4),
+                        backends=("process", "thread"), repeat=1, seed=0):
+    """
+    Measure how sampling the counts of a simulated tree scales with the
+    number of workers of the process and thread pools.
+
+    Parameters
+    ----------
+    cells: int, optional
+        The number of cells to sample
+    genes: int, optional
+        The number of genes of the simulated tree
+    workers: list of int, optional
+        The worker counts to time
+    backends: list of str, optional
+        The pool backends to time
+    repeat: int, optional
+        How many times each configuration is timed; the fastest run is
+        reported
+    seed: int, optional
+        Seed for the simulated tree and the sampled counts
+
+    Returns
+    -------
+    results: dict
+        Wall time in seconds for every backend and worker count
+    """
+    np.random.seed(seed)
+    tree = tr.Tree.from_newick("((D:30,E:20)B:50,C:40)A:35;", genes=genes)
+    tree.default_gene_expression()
+    pseudotime, branches = sim._density_cells(tree, cells)
+    branches, scalings, alpha, beta = sim._prepare_cells(tree, pseudotime,
+                                                         branches, 0.2, 3,
+                                                         True, 0.7)
+
+    results = {"cells": cells, "genes": genes}
+    for backend in backends:
+        for num in workers:
+            def draw(num=num, backend=backend):
+                return sim.draw_counts(tree, pseudotime, branches, scalings,
+                                       alpha, beta, seed=seed, workers=num,
+                                       backend=backend)
+            results["%s_%d" % (backend, num)] = _best_time(draw, repeat)
+    return results
+
+
+def _peak_memory(func):
+    """
+    Run func once and return the peak memory in bytes that was allocated
+    while it ran, as traced by tracemalloc.
+    """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_dtype(cells=20000, genes=2000, repeat=1, seed=0):
+    """
+    Compare peak memory and wall time of sampling a dense expression matrix
+    with float64 means and int64 counts against float32 means and uint16
+    counts.
+
+    Parameters
+    ----------
+    cells: int, optional
+        The number of cells to sample
+    genes: int, optional
+        The number of genes of the simulated tree
+    repeat: int, optional
+        How many times each configuration is timed; the fastest run is
+        reported
+    seed: int, optional
+        Seed for the simulated tree and the sampled counts
+
+    Returns
+    -------
+    results: dict
+        Peak memory in bytes and wall time in seconds of both configurations
+    """
+    np.random.seed(seed)
+    tree = tr.Tree.from_newick("((D:30,E:20)B:50,C:40)A:35;", genes=genes)
+    tree.default_gene_expression()
+
+    results = {"cells": cells, "genes": genes}
+    for name, dtype, count_dtype in [("float64", np.float64, np.int64),
+                                     ("float32", np.float32, np.uint16)]:
+        tree.add_genes(tree.means, dtype=dtype)
+
+        def sample(count_dtype=count_dtype):
+            return sim.sample_density(tree, cells, seed=seed,
+                                      count_dtype=count_dtype)
+        results["%s_means_bytes" % name] = sum(tree.means[b].nbytes
+                                               for b in tree.branches)
+        results["%s_peak_bytes" % name] = _peak_memory(sample)
+        results["%s_time" % name] = _best_time(sample, repeat)
+    return results
+
+
+def balanced_tree(depth, genes, seed=0):
+    """
+    A lineage tree in which every branch bifurcates until the given depth,
+    with BRANCH_TIME pseudotime points per branch.
+
+    Parameters
+    ----------
+    depth: int
+        The number of bifurcations from the root to every leaf; the tree has
+        2**depth - 1 branch points
+    genes: int
+        The number of genes
+    seed: int, optional
+        Seed for the number of expression programs of the tree
+
+    Returns
+    -------
+    tree: Tree
+        The lineage tree, without simulated gene expression
+    """
+    def subtree(name, level):
+        if level == depth:
+            return "%s:%d" % (name, BRANCH_TIME)
+        return "(%s,%s)%s:%d" % (subtree(name + "0", level + 1),
+                                 subtree(name + "1", level + 1), name,
+                                 BRANCH_TIME)
+    np.random.seed(seed)
+    return tr.Tree.from_newick(subtree("B", 0) + ";", genes=genes)
+
+
+def _simulated_tree(depth, genes, seed=0):
+    """
+    A balanced tree with default gene expression.
+    """
+    tree = balanced_tree(depth, genes, seed)
+    np.random.seed(seed)
+    tree.default_gene_expression()
+    return tree
+
+
+# the setup functions of the suite prepare the inputs of one benchmark and
+# return the function that is timed
+def _setup_diffusion(genes, seed):
+    return lambda: sim.diffusion_batch(BRANCH_TIME, genes,
+                                       np.random.default_rng(seed))
+
+
+def _setup_sim_expr_branch(depth, seed):
+    tree = balanced_tree(depth, 10, seed)
+    return lambda: sim.sim_expr_branch(BRANCH_TIME, tree.modules,
+                                       rng=np.random.default_rng(seed))
+
+
+def _setup_simulate_lineage(depth, genes, seed):
+    tree = balanced_tree(depth, genes, seed)
+    return lambda: sim.simulate_lineage(tree, seed=seed, a=0.05)
+
+
+def _setup_simulate_base_gene_exp(depth, genes, seed):
+    tree = balanced_tree(depth, genes, seed)
+    relative_means = sim.simulate_lineage(tree, seed=seed, a=0.05)[0]
+    return lambda: sut.simulate_base_gene_exp(tree, relative_means,
+                                              rng=np.random.default_rng(seed))
+
+
+def _setup_pick_branches(cells, depth, seed):
+    tree = balanced_tree(depth, 10, seed)
+    pseudotime = tree.density_sampler().sample(cells,
+                                               np.random.default_rng(seed))[0]
+    return lambda: sut.pick_branches(tree, pseudotime,
+                                     np.random.default_rng(seed))
+
+
+def _setup_draw_counts(cells, genes, depth, seed):
+    tree = _simulated_tree(depth, genes, seed)
+    pseudotime, branches = sim._density_cells(tree, cells,
+                                              np.random.default_rng(seed))
+    branches, scalings, alpha, beta = sim._prepare_cells(
+        tree, pseudotime, branches, 0.3, 2, True, 0.7,
+        np.random.default_rng(seed))
+    return lambda: sim.draw_counts(tree, pseudotime, branches, scalings, alpha,
+                                   beta, seed=seed)
+
+
+def _setup_sample_density(cells, genes, depth, seed):
+    tree = _simulated_tree(depth, genes, seed)
+    return lambda: sim.sample_density(tree, cells, seed=seed)
+
+
+def _setup_stream_density(cells, genes, depth, seed):
+    tree = _simulated_tree(depth, genes, seed)
+    return lambda: list(sim.stream_density(tree, cells, seed=seed))
+
+
+def _setup_sample_whole_tree(cells, genes, depth, seed):
+    tree = _simulated_tree(depth, genes, seed)
+    n_factor = max(1, cells // len(sim.cover_whole_tree(tree)[0]))
+    return lambda: sim.sample_whole_tree(tree, n_factor, seed=seed)
+
+
+def _setup_sample_whole_tree_restricted(genes, depth, seed):
+    tree = _simulated_tree(depth, genes, seed)
+    return lambda: sim.sample_whole_tree_restricted(tree, seed=seed)
+
+
+def _setup_sample_pseudotime_series(cells, genes, depth, seed):
+    tree = _simulated_tree(depth, genes, seed)
+    series_points = list(np.linspace(0, tree.get_max_time() - 1, 4).astype(int))
+    return lambda: sim.sample_pseudotime_series(tree, cells, series_points, 2.,
+                                                seed=seed)
+
+
+def _negbin_params(cells, genes, seed):
+    rng = np.random.default_rng(seed)
+    means = np.exp(rng.standard_normal((cells, genes)))
+    return cm.get_pr_umi(a=0.2, b=2., m=means)
+
+
+def _setup_sample_negbin(cells, genes, seed):
+    p, r = _negbin_params(cells, genes, seed)
+    return lambda: cm.sample_negbin(p, r, np.random.default_rng(seed))
+
+
+def _setup_sample_amplified(cells, genes, seed):
+    p, r = _negbin_params(cells, genes, seed)
+    return lambda: cm.sample_amplified(p, r, 2., 6.,
+                                       np.random.default_rng(seed))
+
+
+def _setup_score_cells(cells, genes, depth, seed):
+    tree = _simulated_tree(depth, genes, seed)
+    counts = sim.sample_density(tree, cells, seed=seed, scale=False)[0]
+    return lambda: sc.score_cells(tree, counts, 0.3, 2)
+
+
+# every benchmark of the suite: its setup function, which returns the function
+# that is timed, and the parameters that it depends on
+SUITE = {
+    "diffusion": (_setup_diffusion, ("genes",)),
+    "sim_expr_branch": (_setup_sim_expr_branch, ("depth",)),
+    "simulate_lineage": (_setup_simulate_lineage, ("depth", "genes")),
+    "simulate_base_gene_exp": (_setup_simulate_base_gene_exp,
+                               ("depth", "genes")),
+    "pick_branches": (_setup_pick_branches, ("cells", "depth")),
+    "draw_counts": (_setup_draw_counts, ("cells", "genes", "depth")),
+    "sample_density": (_setup_sample_density, ("cells", "genes", "depth")),
+    "stream_density": (_setup_stream_density, ("cells", "genes", "depth")),
+    "sample_whole_tree": (_setup_sample_whole_tree, ("cells", "genes", "depth")),
+    "sample_whole_tree_restricted": (_setup_sample_whole_tree_restricted,
+                                     ("genes", "depth")),
+    "sample_pseudotime_series": (_setup_sample_pseudotime_series,
+                                 ("cells", "genes", "depth")),
+    "sample_negbin": (_setup_sample_negbin, ("cells", "genes")),
+    "sample_amplified": (_setup_sample_amplified, ("cells", "genes")),
+    "score_cells": (_setup_score_cells, ("cells", "genes", "depth")),
+}
+
+
+def run_suite(names=None, cells=(1000,), genes=(100,), depth=(1,), repeat=3,
+              seed=0, callback=None):
+    """
+    Time the benchmarks of the suite for all combinations of the parameters
+    they depend on. Setting up the inputs of a benchmark is not timed.
+
+    Parameters
+    ----------
+    names: list of str, optional
+        The benchmarks to run, all of SUITE if None
+    cells: list of int, optional
+        The numbers of cells
+    genes: list of int, optional
+        The numbers of genes
+    depth: list of int, optional
+        The depths of the balanced lineage trees (see balanced_tree)
+    repeat: int, optional
+        How many times each benchmark is timed; the fastest run is reported
+    seed: int, optional
+        Seed for the inputs and the random streams of every benchmark
+    callback: function, optional
+        Called with every result as soon as it is available
+
+    Returns
+    -------
+    results: list of dict
+        The name, parameters and fastest wall time in seconds of every run
+    """
+    if names is None:
+        names = list(SUITE)
+    unknown = [name for name in names if name not in SUITE]
+    if unknown:
+        raise ValueError("Unknown benchmarks: %s" % ", ".join(unknown))
+    grid = {"cells": cells, "genes": genes, "depth": depth}
+
+    results = []
+    for name in names:
+        setup, params = SUITE[name]
+        for values in itertools.product(*[grid[param] for param in params]):
+            kwargs = dict(zip(params, values))
+            func = setup(seed=seed, **kwargs)
+            result = {"benchmark": name, "params": kwargs, "repeat": repeat,
+                      "time": _best_time(func, repeat)}
+            results.append(result)
+            if callback is not None:
+                callback(result)
+    return results
+
+
+def environment():
+    """
+    Versions of the software the benchmarks ran with, stored next to the
+    results so that runs on different machines are not compared by mistake.
+    """
+    return {"python": platform.python_version(),
+            "numpy": np.__version__,
+            "scipy": sp.__version__,
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def memory_bounds(cells, genes, points, programs, chunk_size=sim.CHUNK_SIZE):
+    """
+    Upper bounds of the peak memory of the stages of a simulation, in bytes.
+    Sampling the counts may allocate the output and a few arrays of the size
+    of a chunk; simulating the expression along the tree a few arrays of the
+    size of the means. Every bound allows for another MiB of small objects.
+
+    Parameters
+    ----------
+    cells: int
+        The number of sampled cells
+    genes: int
+        The number of genes
+    points: int
+        The number of pseudotime points of all branches of the tree
+    programs: int
+        The number of expression programs of the tree
+    chunk_size: int, optional
+        The number of cells for which counts are drawn at once
+
+    Returns
+    -------
+    bounds: dict
+        The bound of every stage that is checked
+    """
+    chunk = 8 * min(cells, chunk_size) * genes
+    means = 8 * (points + programs) * genes
+    slack = 2**20
+    return {"count_matrix": 8 * cells * genes + 8 * chunk + slack,
+            "sample_negbin": 6 * chunk + slack,
+            "take_means": 1.5 * chunk + slack,
+            "default_gene_expression": 4 * means + slack,
+            "simulate_lineage": 3 * means + slack,
+            "simulate_base_gene_exp": 8 * points * genes + slack}
+
+
+def bench_memory(cells=10000, genes=1000, depth=2, seed=0):
+    """
+    Trace the peak memory of every stage of simulating the gene expression of
+    a balanced tree and sampling a dense expression matrix from it, and
+    compare it with memory_bounds.
+
+    Parameters
+    ----------
+    cells: int, optional
+        The number of cells to sample
+    genes: int, optional
+        The number of genes
+    depth: int, optional
+        The depth of the balanced lineage tree (see balanced_tree)
+    seed: int, optional
+        Seed for the simulated tree and the sampled counts
+
+    Returns
+    -------
+    results: dict
+        The peak memory and bound in bytes of every stage, and the stages
+        that exceeded their bound under "exceeded"
+    """
+    tree = balanced_tree(depth, genes, seed)
+    np.random.seed(seed)
+    with ins.record(memory=True) as report:
+        tree.default_gene_expression()
+        sim.sample_density(tree, cells, seed=seed)
+
+    bounds = memory_bounds(cells, genes, int(sum(tree.time)), tree.modules)
+    results = {"cells": cells, "genes": genes, "depth": depth, "stages": {},
+               "exceeded": []}
+    for name, stage in report.stages.items():
+        bound = bounds.get(name)
+        results["stages"][name] = {"peak_bytes": stage.peak_memory,
+                                   "bound_bytes": bound}
+        if bound is not None and stage.peak_memory > bound:
+            results["exceeded"].append(name)
+    return results
+
+
+def _print_result(result):
+    """
+    Print one result of run_suite.
+    """
+    params = ", ".join("%s=%s" % item for item in sorted(result["params"].items()))
+    print("%s(%s): %.4f s" % (result["benchmark"], params, result["time"]))
+
+
+def _print_memory(results):
+    """
+    Print the results of bench_memory.
+    """
+    print("memory (cells=%d, genes=%d, depth=%d):"
+          % (results["cells"], results["genes"], results["depth"]))
+    for name, stage in sorted(results["stages"].items()):
+        bound = "" if stage["bound_bytes"] is None else \
+                " (bound %.1f MiB)" % (stage["bound_bytes"] / 2.**20)
+        print("  %s: %.1f MiB%s" % (name, stage["peak_bytes"] / 2.**20, bound))
+
+
+def main():
+    """
+    Run the benchmarks and print the results.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark PROSSTT samplers.")
+    parser.add_argument("benchmarks", nargs="*",
+                        help="Benchmarks of the suite to run (default: all)")
+    parser.add_argument("--list", action="store_true",
+                        help="List the benchmarks of the suite and exit")
+    parser.add_argument("--cells", type=int, nargs="+", default=[1000],
+                        help="Numbers of cells")
+    parser.add_argument("--genes", type=int, nargs="+", default=[100],
+                        help="Numbers of genes")
+    parser.add_argument("--depth", type=int, nargs="+", default=[1],
+                        help="Depths of the balanced lineage trees")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of timed runs per benchmark")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the inputs and samplers")
+    parser.add_argument("--json", metavar="FILE",
+                        help="Write the results as JSON to FILE ('-' for stdout)")
+    parser.add_argument("--memory", action="store_true",
+                        help="Run the memory benchmark instead of the suite "
+                             "and fail if a stage exceeds its bound")
+    parser.add_argument("--compare", action="store_true",
+                        help="Also run the comparisons of samplers, worker "
+                             "counts and dtypes")
+    parser.add_argument("--size", type=int, default=10**7,
+                        help="Number of negative binomial counts to draw in "
+                             "the sampler comparison")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4],
+                        help="Worker counts for the worker scaling comparison")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, (setup, params) in SUITE.items():
+            print("%s (%s)" % (name, ", ".join(params)))
+        return
+
+    to_json = args.json is not None
+    report = {"environment": environment(), "seed": args.seed}
+    exceeded = []
+    if args.memory:
+        report["memory"] = []
+        for cells, genes, depth in itertools.product(args.cells, args.genes,
+                                                     args.depth):
+            results = bench_memory(cells, genes, depth, args.seed)
+            report["memory"].append(results)
+            exceeded.extend("%s (cells=%d, genes=%d, depth=%d)"
+                            % (name, cells, genes, depth)
+                            for name in results["exceeded"])
+            if not args.json == "-":
+                _print_memory(results)
+    else:
+        callback = None if args.json == "-" else _print_result
+        report["results"] = run_suite(args.benchmarks or None, args.cells,
+                                      args.genes, args.depth, args.repeat,
+                                      args.seed, callback)
+
+    if args.compare:
+        cells = max(args.cells)
+        report["comparisons"] = {
+            "negbin": bench_negbin(size=args.size, repeat=args.repeat,
+                                   seed=args.seed),
+            "count_workers": bench_count_workers(cells=cells,
+                                                 workers=args.workers,
+                                                 repeat=args.repeat,
+                                                 seed=args.seed),
+            "dtype": bench_dtype(cells=cells, repeat=args.repeat,
+                                 seed=args.seed)}
+        if not args.json == "-":
+            for name, results in report["comparisons"].items():
+                for key, value in results.items():
+                    print("%s %s: %s" % (name, key, value))
+
+    if to_json:
+        if args.json == "-":
+            json.dump(report, sys.stdout, indent=2)
+        else:
+            with open(args.json, "w") as out:
+                json.dump(report, out, indent=2)
+    if exceeded:
+        sys.exit("Memory bounds exceeded: %s" % ", ".join(exceeded))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+This module contains the opt-in instrumentation of the simulation. The
+expensive stages of simulation, sim_utils and Tree.default_gene_expression
+report their wall time, and some of them the size of their input, to all
+active recordings::
+
+    from prosstt import instrumentation as ins
+
+    with ins.record() as report:
+        tree.default_gene_expression()
+        simulation.sample_density(tree, 1000)
+    print(report.summary())
+
+If nothing is recorded a stage costs a single check of the list of active
+recordings, so the instrumentation can stay in place in production. Stages
+that run in process pool workers are not recorded; stages in thread pool
+workers are.
+
+With record(memory=True) the peak memory that every stage allocates is traced
+with tracemalloc as well (Python 3.9 or newer). Tracing slows down the
+simulation considerably, and the peaks of stages that run concurrently in
+thread pool workers overlap, so memory is best measured with a single worker.
+"""
+
+import contextlib
+import functools
+import threading
+import time
+import tracemalloc
+
+# the reports that are currently being recorded
+_ACTIVE = []
+_LOCK = threading.Lock()
+# the number of active reports that trace memory, and the traced memory and
+# peak of every stage that is running (see _Stage)
+_MEMORY = {"reports": 0, "started": False, "frames": []}
+
+
+class StageStats(object):
+    """
+    The accumulated measurements of one stage.
+
+    Attributes
+    ----------
+    calls: int
+        How many times the stage ran
+    time: float
+        The total wall time of the stage in seconds
+    max_time: float
+        The wall time of the slowest run in seconds
+    sizes: dict
+        The sum of every size that the stage reported over all runs, e.g. the
+        number of cells
+    peak_memory: int or None
+        The largest number of bytes that a run of the stage allocated on top
+        of the memory in use when it started; None if memory was not traced
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.
+        self.max_time = 0.
+        self.sizes = {}
+        self.peak_memory = None
+
+    def add(self, elapsed, sizes, peak=None):
+        """
+        Add one run of the stage.
+        """
+        self.calls += 1
+        self.time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        for key, value in sizes.items():
+            self.sizes[key] = self.sizes.get(key, 0) + value
+        if peak is not None:
+            self.peak_memory = max(self.peak_memory or 0, peak)
+
+    def as_dict(self):
+        """
+        The measurements as a dictionary of plain types.
+        """
+        return {"calls": self.calls, "time": self.time,
+                "max_time": self.max_time, "sizes": dict(self.sizes),
+                "peak_memory": self.peak_memory}
+
+
+class Report(object):
+    """
+    The measurements of all stages of a recording.
+
+    Parameters
+    ----------
+    callback: function, optional
+        Called with the name, the wall time in seconds and the sizes (a dict)
+        of every run of a stage as soon as it ends, e.g. to forward them to a
+        metrics system. If memory is traced, the peak memory in bytes is
+        passed as a fourth argument
+    memory: bool, optional
+        Whether the peak memory of the stages is traced
+
+    Attributes
+    ----------
+    stages: dict
+        StageStats for every stage that ran, by stage name
+    """
+
+    def __init__(self, callback=None, memory=False):
+        self.callback = callback
+        self.memory = memory
+        self.stages = {}
+
+    def add(self, name, elapsed, sizes, peak=None):
+        """
+        Add one run of a stage.
+        """
+        if not self.memory:
+            peak = None
+        with _LOCK:
+            if name not in self.stages:
+                self.stages[name] = StageStats()
+            self.stages[name].add(elapsed, sizes, peak)
+        if self.callback is None:
+            return
+        if self.memory:
+            self.callback(name, elapsed, sizes, peak)
+        else:
+            self.callback(name, elapsed, sizes)
+
+    def as_dict(self):
+        """
+        The measurements of all stages as a dictionary of plain types, e.g.
+        for json.dump.
+        """
+        return {name: stats.as_dict() for name, stats in self.stages.items()}
+
+    def summary(self):
+        """
+        A table of all stages, slowest first.
+        """
+        header = ("stage", "calls", "time [s]", "max [s]", "peak [MB]",
+                  "sizes")
+        lines = ["%-28s %8s %12s %12s %12s  %s" % header]
+        for name, stats in sorted(self.stages.items(),
+                                  key=lambda item: -item[1].time):
+            sizes = ", ".join("%s=%s" % item
+                              for item in sorted(stats.sizes.items()))
+            peak = "-" if stats.peak_memory is None else \
+                   "%.1f" % (stats.peak_memory / 2.**20)
+            lines.append("%-28s %8d %12.4f %12.4f %12s  %s" % (
+                name, stats.calls, stats.time, stats.max_time, peak, sizes))
+        return "\n".join(lines)
+
+
+class _Stage(object):
+    """
+    Context manager that times one run of a stage and reports it to all
+    active recordings.
+
+    If memory is traced, the stage keeps the traced memory at its start and
+    the highest peak seen so far in a frame. tracemalloc has a single peak,
+    which is reset whenever a stage starts, so every stage folds the peak
+    into the frame of its enclosing stage before that happens.
+    """
+
+    __slots__ = ("name", "sizes", "start", "frame")
+
+    def __init__(self, name, sizes):
+        self.name = name
+        self.sizes = sizes
+        self.start = None
+        self.frame = None
+
+    def size(self, **sizes):
+        """
+        Add sizes that are only known once the stage has started.
+        """
+        self.sizes.update(sizes)
+
+    def __enter__(self):
+        if _MEMORY["reports"] and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            frames = _MEMORY["frames"]
+            if frames:
+                frames[-1][1] = max(frames[-1][1], peak)
+            tracemalloc.reset_peak()
+            self.frame = [current, current]
+            frames.append(self.frame)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        peak = None
+        if self.frame is not None:
+            frames = _MEMORY["frames"]
+            highest = max(self.frame[1], tracemalloc.get_traced_memory()[1])
+            # frames with equal values are different stages, so the frame is
+            # found by identity
+            for i in range(len(frames) - 1, -1, -1):
+                if frames[i] is self.frame:
+                    del frames[i]
+                    break
+            if frames:
+                frames[-1][1] = max(frames[-1][1], highest)
+            peak = highest - self.frame[0]
+        for report in list(_ACTIVE):
+            report.add(self.name, elapsed, self.sizes, peak)
+        return False
+
+
+class _NullStage(object):
+    """
+    The stage that is handed out while nothing is recorded.
+    """
+
+    __slots__ = ()
+
+    def size(self, **sizes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name, **sizes):
+    """
+    Context manager that measures a stage of the simulation.
+
+    Parameters
+    ----------
+    name: str
+        The name of the stage
+    **sizes: int
+        Sizes of the input of the stage, e.g. cells=1000. More can be added
+        with the size method of the returned stage
+
+    Returns
+    -------
+    stage: context manager
+        Reports the wall time and sizes to all active recordings when it
+        exits; does nothing if nothing is recorded
+    """
+    if not _ACTIVE:
+        return _NULL_STAGE
+    return _Stage(name, sizes)
+
+
+def timed(name):
+    """
+    Decorator that measures every call of a function as a stage.
+
+    Parameters
+    ----------
+    name: str
+        The name of the stage
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _ACTIVE:
+                return func(*args, **kwargs)
+            with _Stage(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start(callback=None, memory=False):
+    """
+    Start recording the stages of the simulation.
+
+    Parameters
+    ----------
+    callback: function, optional
+        Called with the name, the wall time in seconds and the sizes of every
+        run of a stage, and with its peak memory as well if memory is traced
+    memory: bool, optional
+        Whether to trace the peak memory of every stage with tracemalloc. If
+        tracemalloc is not tracing yet, it is started and stopped again with
+        the last recording that traces memory. Needs Python 3.9 or newer
+
+    Returns
+    -------
+    report: Report
+        The report into which the stages are recorded until stop is called
+    """
+    if memory and not hasattr(tracemalloc, "reset_peak"):
+        raise RuntimeError("Tracing the memory of stages needs "
+                           "tracemalloc.reset_peak (Python 3.9 or newer)")
+    report = Report(callback, memory)
+    with _LOCK:
+        if memory:
+            if not _MEMORY["reports"] and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _MEMORY["started"] = True
+            _MEMORY["reports"] += 1
+        _ACTIVE.append(report)
+    return report
+
+
+def stop(report):
+    """
+    Stop recording into a report that was returned by start.
+    """
+    with _LOCK:
+        _ACTIVE.remove(report)
+        if report.memory:
+            _MEMORY["reports"] -= 1
+            if not _MEMORY["reports"]:
+                del _MEMORY["frames"][:]
+                if _MEMORY["started"]:
+                    tracemalloc.stop()
+                    _MEMORY["started"] = False
+    return report
+
+
+@contextlib.contextmanager
+def record(callback=None, memory=False):
+    """
+    Record the stages of the simulation while the context is active.
+
+    Parameters
+    ----------
+    callback: function, optional
+        Called with the name, the wall time in seconds and the sizes of every
+        run of a stage, and with its peak memory as well if memory is traced
+    memory: bool, optional
+        Whether to trace the peak memory of every stage with tracemalloc
+
+    Yields
+    ------
+    report: Report
+        The report into which the stages are recorded
+    """
+    report = start(callback, memory)
+    try:
+        yield report
+    finally:
+        stop(report)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+This module contains functions that score count data against a simulated
+lineage tree: the likelihood of every cell at every point of the tree and the
+assignment of cells to their most likely branch and pseudotime.
+"""
+
+import numpy as np
+
+from prosstt import count_model as cm
+from prosstt import tree_utils as tu
+
+
+def mean_grid(tree):
+    """
+    The average gene expression at every point of the tree, i.e. at every
+    pseudotime of every branch.
+
+    Parameters
+    ----------
+    tree: Tree
+        A lineage tree with simulated gene expression
+
+    Returns
+    -------
+    means: ndarray
+        Average gene expression of shape (points, G)
+    branches: ndarray
+        The branch of every point
+    pseudotime: ndarray
+        The pseudotime of every point
+    """
+    packed = tree.means
+    if not isinstance(packed, (tu.BranchMeans, tu.FactorizedMeans)):
+        packed = tu.BranchMeans.pack(packed, tree.branches)
+    branch_times = tree.branch_times()
+    branches = []
+    pseudotime = []
+    rows = []
+    for branch in packed:
+        start = branch_times[branch][0]
+        length = packed.lengths[branch]
+        branches.extend([branch] * length)
+        pseudotime.append(np.arange(start, start + length))
+        rows.append(packed.offsets[branch] + np.arange(length))
+    means = packed.take(np.concatenate(rows))
+    return means, np.array(branches), np.concatenate(pseudotime)
+
+
+def score_cells(tree, counts, alpha, beta, scaling=1., table_size=16,
+                block_size=1000):
+    """
+    Log-likelihood of the counts of every cell at every point of the tree,
+    under the count model that is used to sample UMI counts.
+
+    Parameters
+    ----------
+    tree: Tree
+        A lineage tree with simulated gene expression
+    counts: ndarray or sparse matrix
+        Observed integer counts of shape (cells, G)
+    alpha: float or ndarray
+        Parameter for the count-drawing distribution. Float if it is the same
+        for all genes, else an ndarray
+    beta: float or ndarray
+        Parameter for the count-drawing distribution. Float if it is the same
+        for all genes, else an ndarray
+    scaling: float or ndarray, optional
+        Library size factor that is applied to the average gene expression of
+        all points, either one for all cells or an array with one factor per
+        cell. Cells with the same factor are scored together, so every
+        distinct factor costs one pass over the points; round the factors to
+        a few values when scoring many cells
+    table_size: int, optional
+        The largest count that is handled by the lookup tables of
+        count_model.negbin_loglik
+    block_size: int, optional
+        The number of cells that are scored at once
+
+    Returns
+    -------
+    loglik: ndarray
+        Log-likelihood of every cell at every point, of shape (cells, points)
+    branches: ndarray
+        The branch of every point
+    pseudotime: ndarray
+        The pseudotime of every point
+    """
+    means, branches, pseudotime = mean_grid(tree)
+    means = np.asarray(means, dtype=float)
+    scaling = np.asarray(scaling, dtype=float)
+    if scaling.ndim == 0:
+        p, r = cm.get_pr_umi(a=np.asarray(alpha), b=np.asarray(beta),
+                             m=means * scaling)
+        loglik = cm.negbin_loglik(counts, p, r, table_size=table_size,
+                                  block_size=block_size)
+        return loglik, branches, pseudotime
+    if scaling.shape != (counts.shape[0],):
+        raise ValueError("scaling must be a float or an array with one factor "
+                         "per cell")
+
+    factors, cell_factor = np.unique(scaling, return_inverse=True)
+    loglik = np.empty((counts.shape[0], len(means)))
+    for i, factor in enumerate(factors):
+        cells = np.flatnonzero(cell_factor == i)
+        p, r = cm.get_pr_umi(a=np.asarray(alpha), b=np.asarray(beta),
+                             m=means * factor)
+        loglik[cells] = cm.negbin_loglik(counts[cells], p, r,
+                                         table_size=table_size,
+                                         block_size=block_size)
+    return loglik, branches, pseudotime
+
+
+def assign_cells(tree, counts, alpha, beta, scaling=1., table_size=16,
+                 block_size=1000):
+    """
+    Assign every cell to the point of the tree at which its counts are most
+    likely.
+
+    Parameters
+    ----------
+    tree: Tree
+        A lineage tree with simulated gene expression
+    counts: ndarray or sparse matrix
+        Observed integer counts of shape (cells, G)
+    alpha: float or ndarray
+        Parameter for the count-drawing distribution. Float if it is the same
+        for all genes, else an ndarray
+    beta: float or ndarray
+        Parameter for the count-drawing distribution. Float if it is the same
+        for all genes, else an ndarray
+    scaling: float or ndarray, optional
+        Library size factor that is applied to the average gene expression of
+        all points, either one for all cells or one per cell (see score_cells)
+    table_size: int, optional
+        The largest count that is handled by the lookup tables of
+        count_model.negbin_loglik
+    block_size: int, optional
+        The number of cells that are scored at once
+
+    Returns
+    -------
+    pseudotime: ndarray
+        The most likely pseudotime of every cell
+    branches: ndarray
+        The most likely branch of every cell
+    loglik: ndarray
+        The log-likelihood of every cell at its assigned point
+    """
+    loglik, branches, pseudotime = score_cells(tree, counts, alpha, beta,
+                                               scaling, table_size, block_size)
+    best = np.argmax(loglik, axis=1)
+    return pseudotime[best], branches[best], loglik[np.arange(len(best)), best]
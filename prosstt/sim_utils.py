@@ -7,17 +7,20 @@ assign groups, and functions to pick between alternatives when multiple options
 are possible.
 """
 
-import collections
 from collections import defaultdict
 from collections import deque
+from collections.abc import Iterable
 import operator
 import numbers
 import sys
+import time
 
 import numpy as np
 from numpy import random
 import scipy as sp
 
+from prosstt import instrumentation as ins
+
 
 def print_progress(iteration, total, prefix='', suffix='', decimals=1):
     """
@@ -49,7 +52,7 @@ def print_progress(iteration, total, prefix='', suffix='', decimals=1):
     sys.stdout.flush()
 
 
-def random_partition(k, iterable):
+def random_partition(k, iterable, rng=None):
     """
     Random partition in almost equisized groups.
 
@@ -59,6 +62,9 @@ def random_partition(k, iterable):
         How many partitions to create.
     iterable: array
         The iterable to be partitioned.
+    rng: numpy.random.Generator, optional
+        The random number generator to use. If None, the global numpy random
+        state is used.
 
     Returns
     -------
@@ -66,35 +72,107 @@ def random_partition(k, iterable):
 
     contributed by kennytm on stackoverflow.com/questions/3760752
     """
+    if rng is None:
+        rng = random
+    values = list(iterable)
+    # one draw for all values; the same stream as one randint(k) per value
+    groups = rng.choice(k, size=len(values))
     results = [[] for i in range(k)]
-    for value in iterable:
-        x = random.randint(k)
+    for value, x in zip(values, groups):
         results[x].append(value)
     return results
 
 
 def test_correlation(W, k, cutoff):
     """
-    For a column of a matrix, test if previous columns correlate with it.
+    For a row of a matrix, test if previous rows correlate with it.
 
     Parameters
     ----------
     W: numpy array
         The matrix to test.
     k: int
-        Compare columns from 0 to k-1 with column k.
+        Compare rows from 0 to k-1 with row k.
     cutoff: float
         Correlation above the cut-off will be considered too much. Should be
         between 0 and 1 but is not explicitly tested.
     """
-    for i in range(k - 1, 0):
-        pearson_r = sp.stats.pearsonr(W[k], W[i])
-        if pearson_r[0] > cutoff:
-            return True
-    return False
+    if k == 0:
+        return False
+    normed = normalize_rows(W[:k + 1])
+    pearson_r = np.dot(normed[:k], normed[k])
+    return bool(np.any(pearson_r > cutoff))
+
+
+def normalize_rows(W):
+    """
+    Center every row of a matrix and scale it to unit length, so that the dot
+    product of two normalized rows is their pearson correlation coefficient.
+
+    Parameters
+    ----------
+    W: numpy array
+        The matrix to normalize.
+
+    Returns
+    -------
+    normed: numpy.ndarray
+        The normalized matrix. Constant rows are set to NaN, since their
+        correlation with any other row is not defined.
+    """
+    centered = W - np.mean(W, axis=1, keepdims=True)
+    norms = np.sqrt(np.sum(centered**2, axis=1))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        normed = centered / norms[:, np.newaxis]
+    normed[norms == 0] = np.nan
+    return normed
+
+
+def seed_sequence(seed=None):
+    """
+    Turn a seed into a numpy SeedSequence, from which independent random
+    streams can be spawned.
+
+    Parameters
+    ----------
+    seed: None, int or SeedSequence, optional
+        If None, the entropy is drawn from the global numpy random state, so
+        that numpy.random.seed() keeps simulations reproducible. SeedSequences
+        are returned unchanged.
+
+    Returns
+    -------
+    seq: numpy.random.SeedSequence
+        A seed sequence.
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    if seed is None:
+        seed = random.randint(2**31, size=4).tolist()
+    return np.random.SeedSequence(seed)
+
+
+def as_generator(seed=None):
+    """
+    Turn a seed into a numpy random Generator.
+
+    Parameters
+    ----------
+    seed: None, int, SeedSequence or Generator, optional
+        Generators are returned unchanged; anything else is passed through
+        seed_sequence (so None seeds from the global numpy random state).
+
+    Returns
+    -------
+    rng: numpy.random.Generator
+        A random number generator.
+    """
+    if isinstance(seed, np.random.Generator):
+        return seed
+    return np.random.default_rng(seed_sequence(seed))
 
 
-def create_groups(no_programs, no_genes):
+def create_groups(no_programs, no_genes, rng=None):
     """
     Returns a list of the groups to which each gene belongs.
 
@@ -107,21 +185,26 @@ def create_groups(no_programs, no_genes):
         Number of modules.
     G: int
         Number of genes.
+    rng: numpy.random.Generator, optional
+        The random number generator to use. If None, the global numpy random
+        state is used.
 
     Returns
     -------
     groups: list of ints
         A list of the two modules to which each gene belongs.
     """
-    genes = random.permutation(no_genes)
+    if rng is None:
+        rng = random
+    genes = rng.permutation(no_genes)
     # we want each gene to appear in two groups, in average.
     # If we draw twice it will happen that some genes will take the same
     # group twice, but it should not happen too often.
-    groups1 = random_partition(no_programs, genes)
+    groups1 = random_partition(no_programs, genes, rng)
     # performing the permutation a second time is necessary, else most genes
     # will be in the same modules and we want to mix more
-    genes = random.permutation(no_genes)
-    groups2 = random_partition(no_programs, genes)
+    genes = rng.permutation(no_genes)
+    groups2 = random_partition(no_programs, genes, rng)
     groups = [[i for subz in z for i in subz] for z in zip(groups1, groups2)]
     return groups
 
@@ -159,13 +242,29 @@ def pearson_between_programs(genes, prog1, prog2):
     Returns
     -------
     pearson: numpy.ndarray
-        The pearson correlation coefficient for all genes in the two programs
+        The pearson correlation coefficient for all genes in the two programs.
+        Genes that are constant in either program get NaN, as with
+        scipy.stats.pearsonr.
     """
-    pearson = np.zeros(genes)
     common = min(prog1.shape[0], prog2.shape[0])
-    for gene in range(genes):
-        pearson[gene] = sp.stats.pearsonr(prog1[:common, gene], prog2[:common, gene])[0]
-    return pearson
+    if common < 2:
+        raise ValueError("The programs must share at least two time points")
+    # correlate all genes (columns) at once
+    prog1 = prog1[:common, :genes]
+    prog2 = prog2[:common, :genes]
+    centered1 = prog1 - np.mean(prog1, axis=0)
+    centered2 = prog2 - np.mean(prog2, axis=0)
+    cov = np.einsum("ij,ij->j", centered1, centered2)
+    norms = np.sqrt(np.einsum("ij,ij->j", centered1, centered1)
+                    * np.einsum("ij,ij->j", centered2, centered2))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        pearson = cov / norms
+    # detect constant columns on the raw values: after subtracting the mean,
+    # rounding can leave a constant column with a tiny non-zero norm
+    constant = (np.all(prog1 == prog1[0], axis=0) |
+                np.all(prog2 == prog2[0], axis=0))
+    pearson[constant | (norms == 0)] = np.nan
+    return np.clip(pearson, -1., 1.)
 
 
 def flat_order(n):
@@ -236,20 +335,123 @@ def diverging_parallel(branches, programs, genes, tol=0.5):
     -------
     diverging: numpy.ndarray
         A list of the boolean values: whether each pair of parallel branches
-        diverges or not.
+        diverges or not, in the order of flat_order.
     """
     branches = [b for b in branches if b is not None]
     if len(branches) == 1:
         return [True]
-    indices = flat_order(len(branches))
-    diverging = np.zeros(len(indices), dtype=bool)
-    for index, i, j in indices:
-        br1 = branches[i]
-        br2 = branches[j]
-        pearson = pearson_between_programs(genes, programs[br1], programs[br2])
-        percent_anticorrelated = sum(pearson < 0) / (genes * 1.0)
-        diverging[index] = percent_anticorrelated > tol
-    return diverging
+    fractions = list(_anticorrelated_fractions(branches, programs, genes))
+    if not fractions:
+        return np.zeros(0, dtype=bool)
+    return np.concatenate(fractions) > tol
+
+
+def all_diverging(branches, programs, genes, tol=0.5):
+    """
+    Check whether all pairs of parallel branches diverge enough, see
+    diverging_parallel. The pairs are tested in batches and the test stops at
+    the first batch with a pair that does not diverge.
+
+    Parameters
+    ----------
+    branches: list
+        A list of pairs of parallel branches.
+    programs: Series
+        Relative expression for all expression programs on every branch of the
+        lineage tree.
+    genes: int
+        The number of genes included in the lineage tree.
+    tol: float, optional
+        The percentage of genes that must have anticorrelated expression
+        patterns over pseudotime in order for the branches to be considered
+        diverging.
+
+    Returns
+    -------
+    bool
+        Whether every pair of parallel branches diverges.
+    """
+    branches = [b for b in branches if b is not None]
+    for fractions in _anticorrelated_fractions(branches, programs, genes):
+        if not np.all(fractions > tol):
+            return False
+    return True
+
+
+def divergence_from(branch, others, programs, genes):
+    """
+    The fraction of genes whose expression is anticorrelated between a branch
+    and each of the other branches, see diverging_parallel. Only the pairs
+    that contain branch are tested.
+
+    Parameters
+    ----------
+    branch: str
+        The branch that is compared to the others.
+    others: list
+        The branches to compare it to.
+    programs: Series
+        Relative expression for all expression programs on every branch of the
+        lineage tree.
+    genes: int
+        The number of genes included in the lineage tree.
+
+    Returns
+    -------
+    fractions: numpy.ndarray
+        The fraction of anticorrelated genes for each of the other branches.
+    """
+    if not others:
+        return np.zeros(0)
+    return next(_anticorrelated_fractions([branch] + list(others), programs,
+                                          genes))
+
+
+def _anticorrelated_fractions(branches, programs, genes):
+    """
+    For every pair of branches, the fraction of genes whose expression is
+    anticorrelated over the pseudotime the two branches have in common.
+
+    Each branch is centered only once for each length it is compared over.
+    The pearson correlation and the covariance have the same sign, so the
+    fractions follow from the covariances of one branch with all later
+    branches, which are computed as one batch.
+
+    Yields
+    ------
+    fractions: numpy.ndarray
+        The fractions for the pairs (i, i+1), ..., (i, n-1), for i = 0, ...,
+        n-2, so that all batches together follow the order of flat_order
+    """
+    mats = [programs[b][:, :genes] for b in branches]
+    lengths = np.array([len(mat) for mat in mats])
+    centered = {}
+
+    def center(k, length):
+        if (k, length) not in centered:
+            centered[(k, length)] = _center_columns(mats[k][:length])
+        return centered[(k, length)]
+
+    for i in range(len(mats) - 1):
+        cov = np.empty((len(mats) - i - 1, mats[i].shape[1]))
+        # group the later branches by the length they share with branch i
+        common = np.minimum(lengths[i + 1:], lengths[i])
+        for length in np.unique(common):
+            later = np.flatnonzero(common == length)
+            stack = np.stack([center(i + 1 + j, length) for j in later])
+            cov[later] = np.einsum("tg,btg->bg", center(i, length), stack)
+        yield np.sum(cov < 0, axis=1) / (genes * 1.0)
+
+
+def _center_columns(mat):
+    """
+    Center every column of a matrix. Constant columns are set to exactly
+    zero, so that they never count as anticorrelated (scipy.stats.pearsonr
+    gives NaN for them).
+    """
+    centered = mat - np.mean(mat, axis=0)
+    centered[:, np.all(mat == mat[0], axis=0)] = 0
+    return centered
 
 
 def assign_branches(branch_times, timezone):
@@ -320,31 +522,48 @@ def belongs_to(timezone, branch):
     return (timezone[0] >= branch[0]) and (timezone[1] <= branch[1])
 
 
-def pick_branches(tree, pseudotime):
+def pick_branches(tree, pseudotime, rng=None):
     """
     Randomly pick a corresponding branch for a list of pseudotime values.
 
+    The candidate branches at each pseudotime point are weighted by their
+    density. All cells are assigned at once with a single uniform variate per
+    cell, using the lookup table from Tree.pseudotime_index.
+
     Parameters
     ----------
     tree: Tree
         A lineage tree object.
     pseudotime: list
         A list of pseudotime values.
+    rng: numpy.random.Generator, optional
+        The random number generator to use. If None, the global numpy random
+        state is used.
 
     Returns
     -------
-    branches: list
+    branches: ndarray
         Branch assignments for each pseudotime value.
     """
-    timezone = tree.populate_timezone()
-    assignments = assign_branches(tree.branch_times(), timezone)
-    branches = np.zeros(len(pseudotime), dtype=str)
-    for n, t in enumerate(pseudotime):
-        branches[n] = pick_branch(tree, t, timezone, assignments)
-    return branches
-
-
-def pick_branch(tree, pseudotime, timezones, assignments):
+    if rng is None:
+        rng = random
+    keys, owners, ends, has_mass = tree.pseudotime_index()
+    pseudotime = np.asarray(pseudotime).astype(int)
+    if np.any((pseudotime < 0) | (pseudotime >= len(ends))):
+        msg = "Pseudotime values must lie between 0 and %d" % (len(ends) - 1)
+        raise ValueError(msg)
+    if not np.all(has_mass[pseudotime]):
+        raise ValueError("Pseudotime values must have a positive density")
+
+    with ins.stage("pick_branches", cells=len(pseudotime)):
+        uniform = rng.uniform(size=len(pseudotime))
+        picks = np.searchsorted(keys, pseudotime + uniform, side="right")
+        # guard against t + u being rounded up to t + 1 for large pseudotimes
+        picks = np.minimum(picks, ends[pseudotime] - 1)
+        return np.asarray(tree.branches)[owners[picks]]
+
+
+def pick_branch(tree, pseudotime, timezones, assignments, rng=None):
     """
     Picks one of the possible branches for a cell at a given time point.
 
@@ -358,25 +577,31 @@ def pick_branch(tree, pseudotime, timezones, assignments):
         The pseudotimes at which the timezones start and end.
     assignments: int array
         A list of the possible branches for each timezone.
+    rng: numpy.random.Generator, optional
+        The random number generator to use. If None, the global numpy random
+        state is used.
 
     Returns
     -------
     branch: int
         The branch to which the cell belongs.
     """
+    if rng is None:
+        rng = random
     branch = -1
     for i, zone in enumerate(timezones):
         if pseudotime >= zone[0] and pseudotime <= zone[1]:
             branch = i
             break
     possibilities = assignments[branch]
-    where_in_branch = pseudotime - timezones[branch][0]
+    bt = tree.branch_times()
+    tree_density = tree.density
     densities = np.zeros(len(possibilities))
     for i, b in enumerate(possibilities):
-        densities[i] = tree.density[b][where_in_branch]
+        densities[i] = tree_density[b][pseudotime - bt[b][0]]
     probabilities = densities / densities.sum()
     try:
-        return random.choice(possibilities, p=probabilities)
+        return rng.choice(possibilities, p=probabilities)
     except IndexError:
         print(pseudotime)
         print(timezones)
@@ -406,12 +631,20 @@ def max_relat_exp(tree, relative_means):
     return maxes
 
 
-def simulate_base_gene_exp(tree, relative_means, abs_max=5000, gene_mean=0.8, gene_std=1):
+@ins.timed("simulate_base_gene_exp")
+def simulate_base_gene_exp(tree, relative_means, abs_max=5000, gene_mean=0.8, gene_std=1,
+                           max_rounds=100, rng=None, return_stats=False):
     """
     Samples appropriate base expression values for each gene. The criterion
     applied is that the absolute average gene expression does not surpass a
     certain threshold.
 
+    The base expression of all genes is drawn at once and only the genes that
+    violate the criterion are redrawn. Genes that still fail after max_rounds
+    redraws are sampled directly from the log-normal distribution truncated at
+    their threshold, which is the distribution that the rejection sampler
+    converges to.
+
     Parameters
     ----------
     tree: Tree
@@ -427,30 +660,66 @@ def simulate_base_gene_exp(tree, relative_means, abs_max=5000, gene_mean=0.8, ge
     gene_std: float, optional
         Standard deviation of the log-normal distribution from which the base
         gene expression values are sampled
+    max_rounds: int, optional
+        The number of rounds in which failing genes are redrawn before the
+        truncated distribution is used
+    rng: numpy.random.Generator, optional
+        The random number generator to use. If None, the global numpy random
+        state is used.
+    return_stats: bool, optional
+        Whether to also return the RejectionStats of the run and the redraws
+        of each gene
 
     Returns
     -------
     base_gene_exp: numpy.ndarray
         An array that contains base expression values for each gene
+    stats: RejectionStats
+        All draws as attempts and the rejected ones as "abs_max" failures.
+        exhausted is set if some genes were drawn from the truncated
+        distribution. Only if return_stats is True
+    redraws: numpy.ndarray
+        The number of rejected draws of each gene. Only if return_stats is
+        True
     """
-    base_gene_exp = np.zeros(tree.G)
-
-    log_generator = sp.stats.norm(loc=gene_mean, scale=gene_std)
-
+    if rng is None:
+        rng = random
+    start_time = time.time()
     max_gene_per_branch = max_relat_exp(tree, relative_means)
     max_per_gene = np.max(max_gene_per_branch, axis=1)
-
-    for gene in range(tree.G):
-        tmp = np.exp(log_generator.rvs())
-        counter = 0
-        while tmp * max_per_gene[gene] > abs_max:
-            counter = counter + 1
-            tmp = np.exp(log_generator.rvs())
-        base_gene_exp[gene] = tmp
-    return base_gene_exp
-
-
-def calc_scalings(cells, scale=True, scale_v=0.7):
+    # the criterion exp(x) * max_per_gene <= abs_max on the log scale
+    # genes that are never expressed have no upper bound
+    with np.errstate(divide="ignore"):
+        log_upper = np.log(abs_max) - np.log(max_per_gene)
+
+    log_base = rng.normal(loc=gene_mean, scale=gene_std, size=tree.G)
+    redraws = np.zeros(tree.G, dtype=int)
+    failing = np.flatnonzero(log_base > log_upper)
+    rounds = 0
+    while len(failing) and rounds < max_rounds:
+        redraws[failing] += 1
+        log_base[failing] = rng.normal(loc=gene_mean, scale=gene_std,
+                                       size=len(failing))
+        failing = failing[log_base[failing] > log_upper[failing]]
+        rounds += 1
+
+    if len(failing):
+        upper = (log_upper[failing] - gene_mean) / gene_std
+        log_base[failing] = sp.stats.truncnorm.rvs(-np.inf, upper, loc=gene_mean,
+                                                   scale=gene_std,
+                                                   random_state=rng)
+    base_gene_exp = np.exp(log_base)
+    if not return_stats:
+        return base_gene_exp
+    stats = RejectionStats()
+    stats.attempts = tree.G + int(np.sum(redraws))
+    stats.reject("abs_max", int(np.sum(redraws)))
+    stats.exhausted = len(failing) > 0
+    stats.time = time.time() - start_time
+    return base_gene_exp, stats, redraws
+
+
+def calc_scalings(cells, scale=True, scale_v=0.7, rng=None):
     """
     Obtain library size factors for each cell.
 
@@ -463,6 +732,9 @@ def calc_scalings(cells, scale=True, scale_v=0.7):
     scale_v: float, optional
         The standard deviation of the library size distribution (log-normal
         distribution around 0)
+    rng: numpy.random.Generator, optional
+        The random number generator to use. If None, the global numpy random
+        state is used.
 
     Returns
     -------
@@ -470,7 +742,8 @@ def calc_scalings(cells, scale=True, scale_v=0.7):
         A library size factor for each cell
     """
     if scale:
-        scalings = np.exp(sp.stats.norm.rvs(loc=0., scale=scale_v, size=cells))
+        scalings = np.exp(sp.stats.norm.rvs(loc=0., scale=scale_v, size=cells,
+                                            random_state=rng))
     else:
         scalings = np.ones(cells)
     return scalings
@@ -504,12 +777,12 @@ def process_timeseries_input(series_points, cells, point_std):
         The cell density at each sample point of the time series experiment
     """
     no_samples = len(series_points)
-    if isinstance(cells, collections.Iterable):
+    if isinstance(cells, Iterable):
         cells = np.array(cells, dtype=int)
     elif isinstance(cells, numbers.Number):
         cells = np.array([cells / no_samples] * no_samples, dtype=int)
 
-    if isinstance(point_std, collections.Iterable):
+    if isinstance(point_std, Iterable):
         point_std = np.array(point_std, dtype=float)
     elif isinstance(point_std, numbers.Number):
         point_std = np.array([point_std / no_samples] * no_samples, dtype=float)
@@ -643,3 +916,241 @@ def find_parallel(tree, programs, branch):
         if branch in parallels:
             return np.intersect1d(parallels, list(programs.keys()))
     return [branch, None]
+
+
+class RejectionStats(object):
+    """
+    Bookkeeping of a rejection sampler run, such as sim_expr_branch.
+
+    Attributes
+    ----------
+    attempts: int
+        The number of candidates that were simulated and tested
+    restarts: int
+        How many times the sampler discarded everything and started over
+    time: float
+        Wall time spent in the sampler, in seconds
+    exhausted: bool
+        Whether the attempt or time budget ran out before a solution was
+        found, so that the fallback result was returned
+    failures: dict
+        The number of rejected candidates for every constraint that was
+        violated, e.g. "correlation"
+    """
+
+    def __init__(self):
+        self.attempts = 0
+        self.restarts = 0
+        self.time = 0.
+        self.exhausted = False
+        self.failures = {}
+
+    @property
+    def time_per_attempt(self):
+        """
+        Average wall time per attempt, in seconds.
+        """
+        return self.time / self.attempts if self.attempts else 0.
+
+    def reject(self, reason, count=1):
+        """
+        Count rejected candidates that violated the constraint reason.
+        """
+        self.failures[reason] = self.failures.get(reason, 0) + count
+
+    def merge(self, other):
+        """
+        Add the counts and time of another run to this one.
+        """
+        self.attempts += other.attempts
+        self.restarts += other.restarts
+        self.time += other.time
+        self.exhausted = self.exhausted or other.exhausted
+        for reason, count in other.failures.items():
+            self.reject(reason, count)
+        return self
+
+    def as_dict(self):
+        """
+        The statistics as a dictionary of plain types.
+        """
+        return {"attempts": int(self.attempts), "restarts": int(self.restarts),
+                "time": float(self.time),
+                "time_per_attempt": float(self.time_per_attempt),
+                "exhausted": bool(self.exhausted),
+                "failures": {reason: int(count)
+                             for reason, count in self.failures.items()}}
+
+    def __repr__(self):
+        failures = ", ".join("%s=%i" % item for item in sorted(self.failures.items()))
+        return "RejectionStats(attempts=%i, restarts=%i, time=%.3fs, exhausted=%s, " \
+               "failures={%s})" % (self.attempts, self.restarts, self.time,
+                                   self.exhausted, failures)
+
+
+class LineageDiagnostics(object):
+    """
+    Rejection statistics of simulate_lineage. Every branch is simulated until
+    its relative expression stays below the cutoff and it diverges from its
+    siblings; the expression programs of every candidate are themselves drawn
+    by the rejection sampler sim_expr_branch.
+
+    Attributes
+    ----------
+    branches: dict
+        RejectionStats of the candidates of every branch, with the failures
+        "cutoff" (relative expression above rel_exp_cutoff) and "divergence"
+        (not diverging from the siblings). exhausted tells whether the branch
+        ran out of candidates (max_branch_attempts of simulate_lineage)
+    programs: dict
+        RejectionStats of all sim_expr_branch runs of every branch, with the
+        failure "correlation" (correlated expression programs). exhausted
+        tells whether the accepted programs of the branch were completed by
+        the fallback of sim_expr_branch
+    """
+
+    def __init__(self, branches=None, programs=None):
+        self.branches = {} if branches is None else dict(branches)
+        self.programs = {} if programs is None else dict(programs)
+
+    def total(self):
+        """
+        The statistics of all branches together.
+
+        Returns
+        -------
+        branches: RejectionStats
+            The candidates of all branches
+        programs: RejectionStats
+            All sim_expr_branch runs
+        """
+        branches = RejectionStats()
+        programs = RejectionStats()
+        for branch in self.branches:
+            branches.merge(self.branches[branch])
+            programs.merge(self.programs[branch])
+        return branches, programs
+
+    def as_dict(self):
+        """
+        The statistics of every branch as a dictionary of plain types.
+        """
+        return {str(branch): {"branch": self.branches[branch].as_dict(),
+                              "programs": self.programs[branch].as_dict()}
+                for branch in self.branches}
+
+    def summary(self):
+        """
+        A table with the attempts, failures and time of every branch.
+        """
+        lines = ["%-10s %8s %8s %10s %9s %10s %11s %9s" % (
+            "branch", "attempts", "cutoff", "divergence", "time [s]",
+            "programs", "correlation", "restarts")]
+        for branch, stats in self.branches.items():
+            progs = self.programs[branch]
+            lines.append("%-10s %8i %8i %10i %9.3f %10i %11i %9i" % (
+                branch, stats.attempts, stats.failures.get("cutoff", 0),
+                stats.failures.get("divergence", 0), stats.time,
+                progs.attempts, progs.failures.get("correlation", 0),
+                progs.restarts))
+        return "\n".join(lines)
+
+    def __repr__(self):
+        branches, programs = self.total()
+        return "LineageDiagnostics(branches=%r, programs=%r)" % (branches, programs)
+
+
+class DensitySampler(object):
+    """
+    Draws pseudotime/branch pairs according to the cell density of a lineage
+    tree with Walker's alias method. The alias table is built once in O(n) for
+    the n pseudotime points of the tree; afterwards every cell is drawn in O(1)
+    with a single uniform variate. The sampler only holds arrays, so it can be
+    reused across calls and sent to other processes.
+
+    The sampler is a snapshot of the density at construction time. Use
+    Tree.density_sampler to get a sampler that is rebuilt after
+    Tree.set_density.
+
+    Parameters
+    ----------
+    tree: Tree
+        A lineage tree
+
+    Attributes
+    ----------
+    pseudotime: ndarray
+        Pseudotime of each position on the tree
+    branches: ndarray
+        Branch of each position on the tree
+    prob: ndarray
+        Probability of keeping a position instead of taking its alias
+    alias: ndarray
+        The alternative position of each position
+    """
+
+    def __init__(self, tree):
+        bt = tree.branch_times()
+        time = tree.time
+        tree_density = tree.density
+        self.pseudotime = np.concatenate([np.arange(bt[b][0], bt[b][1] + 1)
+                                          for b in tree.branches])
+        self.branches = np.concatenate([[b] * time[b] for b in tree.branches])
+        density = np.concatenate([np.asarray(tree_density[b], dtype=float)
+                                  for b in tree.branches])
+        if np.any(density < 0) or not density.sum() > 0:
+            raise ValueError("The density must be non-negative and not all zero")
+        self.prob, self.alias = self._alias_table(density / density.sum())
+        for arr in (self.pseudotime, self.branches, self.prob, self.alias):
+            arr.flags.writeable = False
+
+    @staticmethod
+    def _alias_table(probabilities):
+        """
+        Build the alias table of a discrete distribution (Vose's method).
+        """
+        n = len(probabilities)
+        scaled = probabilities * n
+        prob = np.ones(n)
+        alias = np.arange(n)
+        small = list(np.flatnonzero(scaled < 1))
+        large = list(np.flatnonzero(scaled >= 1))
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            prob[less] = scaled[less]
+            alias[less] = more
+            scaled[more] = scaled[more] + scaled[less] - 1
+            if scaled[more] < 1:
+                small.append(more)
+            else:
+                large.append(more)
+        # whatever remains has probability 1 up to rounding errors
+        return prob, alias
+
+    def sample(self, no_cells, rng=None):
+        """
+        Draw pseudotime/branch pairs.
+
+        Parameters
+        ----------
+        no_cells: int
+            Number of cells to sample
+        rng: numpy.random.Generator, optional
+            The random number generator to use. If None, the global numpy
+            random state is used.
+
+        Returns
+        -------
+        sample_time: ndarray
+            Pseudotime values of the sampled cells
+        sample_branches: ndarray
+            The branch to which each sampled cell belongs
+        """
+        if rng is None:
+            rng = random
+        uniform = rng.uniform(size=no_cells) * len(self.prob)
+        column = uniform.astype(int)
+        keep = (uniform - column) < self.prob[column]
+        sample = np.where(keep, column, self.alias[column])
+        return self.pseudotime[sample], self.branches[sample]
@@ -4,21 +4,65 @@
 This module contains all the functions that produce simulations. This includes
 the simulation of expression programs, coefficients that map expr. programs to
 genes, and different sampling strategies for (pseudotime, branch) pairs.
+
+Sampling parameters
+-------------------
+The samplers (sample_density, sample_whole_tree, sample_pseudotime_series,
+sample_whole_tree_restricted, their stream_* counterparts and draw_counts)
+share the following optional parameters:
+
+sparse: bool
+    Return the expression matrix as a scipy.sparse.csr_matrix. Counts are
+    converted chunk by chunk, so the dense matrix is never allocated. Only
+    for the sample_* functions
+chunk_size: int
+    The number of cells for which counts are drawn at once (CHUNK_SIZE per
+    default). The stream_* functions yield chunks of at most this many cells
+seed: None, int or SeedSequence
+    Master seed. The cells and the counts of every chunk are drawn with their
+    own streams spawned from it, so that the result depends on seed and
+    chunk_size but not on the number of workers or the backend. If None, the
+    streams are seeded from the global numpy random state
+workers: int
+    The number of processes or threads that sample counts in parallel
+backend: str
+    "process" samples in a process pool, "thread" in a thread pool that
+    shares the means with the caller and writes directly into the output
+count_dtype: dtype
+    Integer type of the counts, e.g. numpy.uint16 to save memory. Counts that
+    do not fit promote the result to a wider unsigned type
+amplification: tuple of float
+    Mean and variance (mu_amp, s2_amp) of the number of reads per transcript.
+    If given, amplified read counts (non-UMI data) are sampled instead of UMI
+    counts
 """
 
+from collections import deque
+from concurrent import futures
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import sys
+import time
 import warnings
 
 import numpy as np
 from numpy import random
 import pandas as pd
 import scipy as sp
+from scipy import sparse as sps
 
 from prosstt import sim_utils as sut
 from prosstt import count_model as cm
+from prosstt import instrumentation as ins
+from prosstt import tree_utils as tu
+
+# default number of cells for which counts are sampled at once
+CHUNK_SIZE = 1000
 
 
-def sim_expr_branch(branch_length, expr_progr, cutoff=0.2, max_loops=100):
+@ins.timed("sim_expr_branch")
+def sim_expr_branch(branch_length, expr_progr, cutoff=0.2, max_loops=100,
+                    block_size=8, max_attempts=10000, max_time=None,
+                    fallback="best", return_stats=False, rng=None):
     """
     Return expr_progr diffusion processes of length T as a matrix W. The output of
     sim_expr_branch is complementary to _sim_coeff_beta.
@@ -30,16 +74,27 @@ def sim_expr_branch(branch_length, expr_progr, cutoff=0.2, max_loops=100):
     (from 0 to a small positive float, so from a gene not being expressed to a
     gene being expressed at 2x, 3x of its "normal" level).
 
-    After each new diffusion process is added the function checks whether the
-    new diffusion correlates with any of the older ones. If the correlation is
-    too high (above 0.5 per default), the last diffusion process will be
-    replaced with a new one until one is found that does not correlate with any
-    other columns of W or a suitable replacement hasn't been found after 100
-    tries.
+    Each new diffusion process is only accepted if it does not correlate with
+    any of the already accepted ones. If the correlation is above cutoff (0.2
+    per default; simulate_lineage passes its intra_branch_tol, 0.5 per
+    default), the candidate is discarded and the next one is tested, until
+    one is found that does not correlate with any other columns of W or a
+    suitable replacement hasn't been found after max_loops tries. In the
+    latter case W is reset and the simulation starts over.
+
+    Candidates are simulated and tested in blocks: the normalized accepted
+    programs are kept, so that the correlations of a whole block with them are
+    a single matrix product, and they are updated incrementally whenever a
+    candidate of the block is accepted.
 
     Obviously this gets more probable the higher the number of components is -
     it might be advisable to change the number of maximum loops allowed or
-    the cutoff in order to reduce runtime for a high number of components.
+    the cutoff in order to reduce runtime for a high number of components. The
+    total work is bounded by max_attempts and max_time; once either budget is
+    spent, the fallback strategy decides the result. With a cutoff of 0.5, 30
+    components take about 2000 attempts, while 50 components exhaust the
+    default budget; the "best" fallback then breaks the correlation
+    constraint for some of the programs and says so with a warning.
 
     Parameters
     ----------
@@ -55,38 +110,161 @@ def sim_expr_branch(branch_length, expr_progr, cutoff=0.2, max_loops=100):
         The maximum number of times the method will try simulating a new
         diffusion process that doesn't correlate with all previous ones in W
         before resetting the matrix and starting over
+    block_size: int, optional
+        The minimum number of candidate diffusion processes simulated at once
+    max_attempts: int or None, optional
+        The maximum number of candidate diffusion processes tested over all
+        restarts. None for no limit
+    max_time: float or None, optional
+        The maximum time in seconds to spend in the rejection loop. None for no
+        limit
+    fallback: str, optional
+        What to do if the budget is exhausted. "best" keeps the programs of
+        the restart that got furthest, fills the remaining ones with the
+        least correlated candidates of a fresh block and issues a
+        RuntimeWarning; "raise" raises a RuntimeError
+    return_stats: bool, optional
+        Whether to also return the RejectionStats of the run
+    rng: numpy.random.Generator, optional
+        The random number generator to use. If None, the global numpy random
+        state is used
 
     Returns
     -------
     W: ndarray
         Output array
+    stats: RejectionStats
+        Attempts, "correlation" failures, restarts and time spent; only if
+        return_stats is True
+    """
+    programs, stats, filled = _expr_branch(branch_length, expr_progr, cutoff,
+                                           max_loops, block_size, max_attempts,
+                                           max_time, fallback, rng)
+    if filled:
+        msg = "Could not simulate %i uncorrelated programs within the budget " \
+              "(%r); %i programs may correlate above %g" \
+              % (expr_progr, stats, filled, cutoff)
+        warnings.warn(msg, RuntimeWarning, stacklevel=2)
+    if return_stats:
+        return programs, stats
+    return programs
+
+
+def _expr_branch(branch_length, expr_progr, cutoff=0.2, max_loops=100,
+                 block_size=8, max_attempts=10000, max_time=None,
+                 fallback="best", rng=None):
+    """
+    The rejection sampler behind sim_expr_branch, without the warning about
+    the fallback. Returns the programs (of shape branch_length x expr_progr),
+    the RejectionStats and the number of programs that the fallback filled
+    in regardless of their correlation.
     """
+    if fallback not in ("best", "raise"):
+        raise ValueError("fallback must be 'best' or 'raise', not %s" % fallback)
+    stats = sut.RejectionStats()
+    start_time = time.time()
+
     programs = np.zeros((expr_progr, branch_length))
+    normed = np.zeros((expr_progr, branch_length))
+    best_k = 0
+    best_programs = programs.copy()
     k = 0
     loops = 0
     while k < expr_progr:
-        programs[k] = diffusion(branch_length)
-
-        correlates = sut.test_correlation(programs, k, cutoff)
-        if correlates:
+        if _budget_spent(stats, start_time, max_attempts, max_time):
+            stats.exhausted = True
+            break
+
+        candidates = diffusion_batch(branch_length, max(expr_progr - k, block_size),
+                                     rng)
+        cand_normed = sut.normalize_rows(candidates)
+        correlates = np.any(np.dot(cand_normed, normed[:k].T) > cutoff, axis=1)
+
+        i = 0
+        while i < len(candidates) and k < expr_progr:
+            passing = np.flatnonzero(~correlates[i:])
+            rejected = len(correlates) - i if len(passing) == 0 else passing[0]
             # repeat and hope it works better this time
-            loops += 1
-            continue
-        else:
+            loops += rejected
+            stats.attempts += rejected
+            stats.reject("correlation", rejected)
+            if loops > max_loops:
+                # we tried so hard
+                # and came so far
+                # but in the end
+                # it doesn't even matter
+                if k > best_k:
+                    best_k = k
+                    best_programs[:k] = programs[:k]
+                stats.restarts += 1
+                k = 0
+                loops = 0
+                break
+            if len(passing) == 0:
+                break
+
+            accepted = i + passing[0]
+            programs[k] = candidates[accepted]
+            normed[k] = cand_normed[accepted]
+            # the remaining candidates now also have to pass the new program
+            rest = slice(accepted + 1, None)
+            correlates[rest] |= np.dot(cand_normed[rest], normed[k]) > cutoff
+            stats.attempts += 1
             loops = 0
             k += 1
+            i = accepted + 1
+
+    filled = 0
+    if stats.exhausted:
+        if fallback == "raise":
+            stats.time = time.time() - start_time
+            msg = "Could not simulate %i uncorrelated programs within the budget (%r)" \
+                  % (expr_progr, stats)
+            raise RuntimeError(msg)
+        if best_k > k:
+            k = best_k
+            programs[:k] = best_programs[:k]
+            normed[:k] = sut.normalize_rows(programs[:k])
+        filled = expr_progr - k
+        _complete_programs(programs, normed, k, block_size, stats, rng)
+
+    stats.time = time.time() - start_time
+    return np.transpose(programs), stats, filled
+
+
+def _budget_spent(stats, start_time, max_attempts, max_time):
+    """
+    Check whether a rejection sampler has used up its attempt or time budget.
+    """
+    if max_attempts is not None and stats.attempts >= max_attempts:
+        return True
+    if max_time is not None and time.time() - start_time >= max_time:
+        return True
+    return False
 
-        if loops > max_loops:
-            # we tried so hard
-            # and came so far
-            # but in the end
-            # it doesn't even matter
-            return sim_expr_branch(branch_length, expr_progr, cutoff=cutoff)
 
-    return np.transpose(programs)
+def _complete_programs(programs, normed, k, block_size, stats, rng=None):
+    """
+    Fill the programs from k onwards without rejection, each time taking the
+    candidate of a fresh block that correlates least with the programs that
+    are already in place.
+    """
+    expr_progr, branch_length = programs.shape
+    while k < expr_progr:
+        candidates = diffusion_batch(branch_length, block_size, rng)
+        cand_normed = sut.normalize_rows(candidates)
+        stats.attempts += block_size
+        if k == 0:
+            best = 0
+        else:
+            max_corr = np.max(np.dot(cand_normed, normed[:k].T), axis=1)
+            best = np.argmin(np.nan_to_num(max_corr, nan=-np.inf))
+        programs[k] = candidates[best]
+        normed[k] = cand_normed[best]
+        k += 1
 
 
-def diffusion(steps):
+def diffusion(steps, rng=None):
     """
     Diffusion process with momentum term. Returns a random walk with values
     usually between 0 and 1.
@@ -95,33 +273,62 @@ def diffusion(steps):
     ----------
     steps: int
         The length of the diffusion process.
+    rng: numpy.random.Generator, optional
+        The random number generator to use. If None, the global numpy random
+        state is used.
 
     Returns
     -------
     walk: float array
         A diffusion process with a specified number of steps.
     """
-    velocity = np.zeros(steps)
-    walk = np.zeros(steps)
+    return diffusion_batch(steps, 1, rng)[0]
 
-    # walk[0] = sp.stats.uniform.rvs()
-    walk[0] = 0
-    velocity[0] = sp.stats.norm.rvs(loc=0, scale=0.2)
 
+def diffusion_batch(steps, n_walks, rng=None):
+    """
+    Simulate several independent diffusion processes with momentum term at
+    once. Every walk follows the same law as the one produced by diffusion();
+    all the noise is drawn up front and the momentum recurrence is advanced for
+    all walks simultaneously.
+
+    Parameters
+    ----------
+    steps: int
+        The length of each diffusion process.
+    n_walks: int
+        The number of diffusion processes to simulate.
+    rng: numpy.random.Generator, optional
+        The random number generator to use. If None, the global numpy random
+        state is used.
+
+    Returns
+    -------
+    walks: ndarray
+        Array of shape (n_walks, steps); every row is a diffusion process.
+    """
+    if rng is None:
+        rng = random
+    velocity = np.zeros((n_walks, steps))
+
+    velocity[:, 0] = rng.normal(loc=0, scale=0.2, size=n_walks)
     s_eps = 2 / steps
-    eta = sp.stats.uniform.rvs()
+    eta = rng.uniform(size=n_walks)
+    epsilon = rng.normal(loc=0, scale=s_eps, size=(n_walks, steps - 1))
 
+    # amortize the update
+    damping = 0.95 - eta
     for t in range(0, steps - 1):
-        walk[t + 1] = walk[t] + velocity[t]
-
-        epsilon = sp.stats.norm.rvs(loc=0, scale=s_eps)
-        # amortize the update
-        velocity[t + 1] = 0.95 * velocity[t] + epsilon - eta * velocity[t]
+        velocity[:, t + 1] = damping * velocity[:, t] + epsilon[:, t]
 
-    return walk
+    # walk[0] = 0 and walk[t + 1] = walk[t] + velocity[t]
+    walks = np.zeros((n_walks, steps))
+    np.cumsum(velocity[:, :-1], axis=1, out=walks[:, 1:])
+    return walks
 
 
-def simulate_coefficients(tree, fallback_a=0.04, **kwargs):
+@ins.timed("simulate_coefficients")
+def simulate_coefficients(tree, fallback_a=0.04, rng=None, **kwargs):
     """
     H encodes how G genes are expressed by defining their membership to K
     expression modules (coded in a matrix W). H could be told to encode
@@ -139,6 +346,9 @@ def simulate_coefficients(tree, fallback_a=0.04, **kwargs):
     a: float, optional
         Shape parameter of Gamma distribution or first shape parameter of Beta
         distribution
+    rng: numpy.random.Generator, optional
+        The random number generator to use. If None, the global numpy random
+        state is used
     **kwargs: float
         Additional parameter (float b) if Beta distribution is to be used
 
@@ -149,16 +359,16 @@ def simulate_coefficients(tree, fallback_a=0.04, **kwargs):
     if "a" not in kwargs.keys():
         warnings.warn(
             "No argument 'a' specified in kwargs: using gamma and a=0.04", UserWarning)
-        return _sim_coeff_gamma(tree, fallback_a)
+        return _sim_coeff_gamma(tree, fallback_a, rng=rng)
     # if a, b are present: beta distribution
     if "b" in kwargs.keys():
-        groups = sut.create_groups(tree.modules, tree.G)
-        return _sim_coeff_beta(tree, groups)
+        groups = sut.create_groups(tree.modules, tree.G, rng)
+        return _sim_coeff_beta(tree, groups, rng=rng)
     else:
-        return _sim_coeff_gamma(tree, a=kwargs['a'])
+        return _sim_coeff_gamma(tree, a=kwargs['a'], rng=rng)
 
 
-def _sim_coeff_beta(tree, groups, a=2, b=2):
+def _sim_coeff_beta(tree, groups, a=2, b=2, rng=None):
     """
     Draw weights for the contribution of tree expression programs to gene
     expression from a Beta distribution.
@@ -173,6 +383,9 @@ def _sim_coeff_beta(tree, groups, a=2, b=2):
         First shape parameter of the Beta distribution
     b: float, optional
         Second shape parameter of the Beta distribution
+    rng: numpy.random.Generator, optional
+        The random number generator to use. If None, the global numpy random
+        state is used
 
     Returns
     -------
@@ -182,11 +395,11 @@ def _sim_coeff_beta(tree, groups, a=2, b=2):
     H = np.zeros((tree.modules, tree.G))
     for k in range(tree.modules):
         for gene in groups[k]:
-            H[k][gene] += sp.stats.beta.rvs(a, b)
+            H[k][gene] += sp.stats.beta.rvs(a, b, random_state=rng)
     return H
 
 
-def _sim_coeff_gamma(tree, a=0.05):
+def _sim_coeff_gamma(tree, a=0.05, rng=None):
     """
     Draw weights for the contribution of tree expression programs to gene
     expression from a Gamma distribution.
@@ -197,6 +410,9 @@ def _sim_coeff_gamma(tree, a=0.05):
         A lineage tree
     a: float, optional
         Shape parameter of the Gamma distribution
+    rng: numpy.random.Generator, optional
+        The random number generator to use. If None, the global numpy random
+        state is used
 
     Returns
     -------
@@ -205,12 +421,15 @@ def _sim_coeff_gamma(tree, a=0.05):
     """
     K = tree.modules
     G = tree.G
-    coefficients = np.reshape(sp.stats.gamma.rvs(a, size=K * G), (K, G))
+    coefficients = np.reshape(sp.stats.gamma.rvs(a, size=K * G, random_state=rng), (K, G))
     return coefficients
 
 
+@ins.timed("simulate_lineage")
 def simulate_lineage(tree, rel_exp_cutoff=8, intra_branch_tol=0.5,
-                     inter_branch_tol=0, **kwargs):
+                     inter_branch_tol=0, seed=None, workers=1, backend="process",
+                     dtype=None, diagnostics=False, max_branch_attempts=1000,
+                     fallback="best", **kwargs):
     """
     Simulate gene expression for each point of the lineage tree (each
     possible pseudotime/branch combination). The simulation will try to make
@@ -218,6 +437,20 @@ def simulate_lineage(tree, rel_exp_cutoff=8, intra_branch_tol=0.5,
     too heavily and b) gene expression programs in parallel branches diverge
     enough.
 
+    The branches that share a parent form a sibling group. The siblings of a
+    group are simulated one after the other, each of them until it stays below
+    rel_exp_cutoff and diverges from the siblings before it, or until
+    max_branch_attempts candidates were rejected. A group only
+    depends on the last programs of its parent, so groups in different
+    subtrees are simulated concurrently if workers > 1. Every branch draws
+    from its own random stream, so the result does not depend on the number
+    of workers or on the order in which groups finish.
+
+    If the candidates of a branch ran out, or its expression programs could
+    only be completed by the fallback of sim_expr_branch, a single
+    RuntimeWarning names all such branches, even if they were simulated in a
+    process pool; they are also marked as exhausted in the diagnostics.
+
     Parameters
     ----------
     tree: Tree
@@ -231,6 +464,28 @@ def simulate_lineage(tree, rel_exp_cutoff=8, intra_branch_tol=0.5,
     inter_branch_tol: float, optional
         The threshold for anticorrelation between relative gene expression in
         parallel branches
+    seed: None, int or SeedSequence, optional
+        Master seed of the simulation. If None, the global numpy random state
+        is used for the coefficients and to seed the branches
+    workers: int, optional
+        The number of processes or threads that simulate sibling groups in
+        parallel
+    backend: str, optional
+        "process" simulates the sibling groups in a process pool, "thread" in
+        a thread pool
+    dtype: dtype, optional
+        Floating point type of the returned arrays, e.g. numpy.float32. The
+        simulation itself runs in float64. None keeps float64
+    diagnostics: bool, optional
+        Whether to also return the LineageDiagnostics of the rejection
+        sampling: the attempts, failures and time of every branch
+    max_branch_attempts: int, optional
+        The maximum number of candidates that are simulated for every branch
+    fallback: str, optional
+        What to do if a branch runs out of candidates. "best" keeps the
+        candidate that came closest: of the ones below rel_exp_cutoff the one
+        that diverges most from its accepted siblings, or else the one with
+        the lowest maximum; "raise" raises a RuntimeError
     **kwargs: various, optional
         Accepts parameters for coefficient simulation; float a if coefficients
         are generated by a Gamma distribution or floats a, b if the coefficients
@@ -246,41 +501,284 @@ def simulate_lineage(tree, rel_exp_cutoff=8, intra_branch_tol=0.5,
     coefficients: ndarray
         Array that contains the contribution weight of each expr. program for
         each gene
+    diagnostics: LineageDiagnostics
+        Rejection statistics of every branch; only if diagnostics is True
     """
     if not len(tree.time) == tree.num_branches:
         raise ValueError("the parameters are not enough for %i branches" %
                          tree.num_branches)
+    if backend not in ("process", "thread"):
+        raise ValueError("backend must be 'process' or 'thread', not %s" % backend)
+    if fallback not in ("best", "raise"):
+        raise ValueError("fallback must be 'best' or 'raise', not %s" % fallback)
+
+    coeff_rng, branch_seq = _split_seed(seed)
+    coefficients = simulate_coefficients(tree, rng=coeff_rng, **kwargs)
+    bfs = list(sut.breadth_first_branches(tree))
+    seeds = dict(zip(bfs, branch_seq.spawn(len(bfs))))
+
+    # the root forms a group of its own, every other group shares a parent
+    treedict = tree.as_dictionary()
+    groups = {None: [tree.root]}
+    for branch in bfs:
+        children = treedict.get(branch, ())
+        if children:
+            groups[branch] = [b for b in bfs if b in children]
+    settings = (coefficients, tree.modules, tree.G, rel_exp_cutoff,
+                intra_branch_tol, inter_branch_tol, max_branch_attempts,
+                fallback)
 
-    topology = np.array(tree.topology)
-    coefficients = simulate_coefficients(tree, **kwargs)
-    bfs = sut.breadth_first_branches(tree)
     programs = {}
     rel_means = {}
+    stats = sut.LineageDiagnostics()
+    for result in _resolve_groups(groups, tree.time, seeds, settings, workers,
+                                  backend):
+        programs.update(result[0])
+        rel_means.update(result[1])
+        stats.branches.update(result[2])
+        stats.programs.update(result[3])
+
+    degraded = [str(b) for b in bfs if stats.programs[b].exhausted]
+    if degraded:
+        msg = "The expression programs of the branches %s exhausted the budget " \
+              "of sim_expr_branch; some of them correlate above " \
+              "intra_branch_tol=%g" % (", ".join(degraded), intra_branch_tol)
+        warnings.warn(msg, RuntimeWarning, stacklevel=2)
+    degraded = [str(b) for b in bfs if stats.branches[b].exhausted]
+    if degraded:
+        msg = "The branches %s ran out of candidates after %i attempts; they " \
+              "may exceed rel_exp_cutoff or not diverge from their siblings" \
+              % (", ".join(degraded), max_branch_attempts)
+        warnings.warn(msg, RuntimeWarning, stacklevel=2)
+
+    if dtype is not None:
+        rel_means = {b: rel_means[b].astype(dtype, copy=False) for b in bfs}
+        programs = {b: programs[b].astype(dtype, copy=False) for b in bfs}
+        coefficients = coefficients.astype(dtype, copy=False)
+    result = (pd.Series({b: rel_means[b] for b in bfs}),
+              pd.Series({b: programs[b] for b in bfs}),
+              coefficients)
+    if diagnostics:
+        stats = sut.LineageDiagnostics({b: stats.branches[b] for b in bfs},
+                                       {b: stats.programs[b] for b in bfs})
+        return result + (stats,)
+    return result
+
+
+def _resolve_groups(groups, lengths, seeds, settings, workers=1, backend="process"):
+    """
+    Simulate the sibling groups of a lineage tree, starting with the root
+    group and scheduling the group of a branch as soon as the branch itself
+    is simulated.
 
-    for branch in bfs:
-        programs[branch] = sim_expr_branch(tree.time[branch], tree.modules, cutoff=intra_branch_tol)
-        programs[branch] = sut.adjust_to_parent(programs, branch, topology)
-        rel_means[branch] = np.dot(programs[branch], coefficients)
-        above_cutoff = (np.max(rel_means[branch]) > rel_exp_cutoff)
-        parallels = sut.find_parallel(tree, programs, branch)
-        diverges = sut.diverging_parallel(parallels, rel_means, tree.G, tol=inter_branch_tol)
-        while above_cutoff or not all(diverges):
-            programs[branch] = sim_expr_branch(tree.time[branch], tree.modules, cutoff=intra_branch_tol)
-            programs[branch] = sut.adjust_to_parent(programs, branch, topology)
-            rel_means[branch] = np.dot(programs[branch], coefficients)
-            above_cutoff = (np.max(rel_means[branch]) > rel_exp_cutoff)
-            parallels = sut.find_parallel(tree, programs, branch)
-            diverges = sut.diverging_parallel(parallels, rel_means, tree.G, tol=inter_branch_tol)
-
-    return (pd.Series(rel_means),
-            pd.Series(programs),
-            coefficients)
-
-
-def sample_whole_tree_restricted(tree, alpha=0.2, beta=3):
+    Parameters
+    ----------
+    groups: dict
+        The children of every branch that has any, in the order in which they
+        are simulated; the key None holds the root
+    lengths: Series
+        The length of each branch in pseudotime units
+    seeds: dict
+        The SeedSequence of each branch
+    settings: tuple
+        Coefficients, number of programs and genes and the tolerances that
+        are passed on to _simulate_sibling_group
+    workers: int, optional
+        The number of processes or threads that simulate groups in parallel
+    backend: str, optional
+        Either "process" or "thread"
+
+    Yields
+    ------
+    result: tuple
+        The expression programs, relative mean expression and rejection
+        statistics of each branch of a group, as returned by
+        _simulate_sibling_group
+    """
+    ready = deque([None])
+    parent_rows = {}
+
+    def job_args(parent):
+        children = groups[parent]
+        return (children, parent_rows.pop(parent, None),
+                [lengths[c] for c in children], [seeds[c] for c in children])
+
+    def schedule(result):
+        for branch, branch_programs in result[0].items():
+            if branch in groups:
+                parent_rows[branch] = branch_programs[-1:]
+                ready.append(branch)
+
+    if workers == 1:
+        while ready:
+            result = _simulate_sibling_group(*job_args(ready.popleft()) + settings)
+            schedule(result)
+            yield result
+        return
+
+    if backend == "thread":
+        pool = ThreadPoolExecutor(max_workers=workers)
+
+        def submit(args):
+            return pool.submit(_simulate_sibling_group, *args + settings)
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers,
+                                   initializer=_init_lineage_worker,
+                                   initargs=settings)
+
+        def submit(args):
+            return pool.submit(_pool_sibling_group, *args)
+
+    with pool:
+        running = set()
+        while ready or running:
+            while ready:
+                running.add(submit(job_args(ready.popleft())))
+            done, running = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            for job in done:
+                result = job.result()
+                schedule(result)
+                yield result
+
+
+# the settings of simulate_lineage in a process pool worker
+_LINEAGE_STATE = {}
+
+
+def _init_lineage_worker(*settings):
+    """
+    Initializer of the process pool workers of _resolve_groups.
+    """
+    _LINEAGE_STATE["settings"] = settings
+
+
+def _pool_sibling_group(children, parent_row, lengths, seeds):
+    """
+    Simulate a sibling group in a process pool worker.
+    """
+    return _simulate_sibling_group(children, parent_row, lengths, seeds,
+                                   *_LINEAGE_STATE["settings"])
+
+
+def _simulate_sibling_group(children, parent_row, lengths, seeds, coefficients,
+                            modules, genes, rel_exp_cutoff, intra_branch_tol,
+                            inter_branch_tol, max_branch_attempts=1000,
+                            fallback="best"):
+    """
+    Simulate the expression programs of a group of branches that share a
+    parent. Every branch is simulated until its relative expression stays
+    below rel_exp_cutoff and it diverges from the branches accepted before
+    it, or until max_branch_attempts candidates were simulated.
+
+    Parameters
+    ----------
+    children: list
+        The branches of the group
+    parent_row: ndarray or None
+        The last row of the programs of the parent, to which every branch is
+        adjusted; None for the root
+    lengths: list of int
+        The length of each branch in pseudotime units
+    seeds: list of SeedSequence
+        The seed of each branch
+    coefficients: ndarray
+        The contribution weight of each expr. program for each gene
+    modules: int
+        The number of expression programs
+    genes: int
+        The number of genes
+    rel_exp_cutoff: float
+        The log threshold for the maximum average expression
+    intra_branch_tol: float
+        The threshold for correlation between programs of the same branch
+    inter_branch_tol: float
+        The threshold for anticorrelation between parallel branches
+    max_branch_attempts: int, optional
+        The maximum number of candidates of every branch
+    fallback: str, optional
+        "best" keeps the candidate that came closest if a branch runs out of
+        candidates, "raise" raises a RuntimeError
+
+    Returns
+    -------
+    programs: dict
+        Expression programs of each branch
+    rel_means: dict
+        Relative mean expression of each branch
+    branch_stats: dict
+        RejectionStats of the candidates of each branch; exhausted if the
+        branch ran out of candidates
+    program_stats: dict
+        RejectionStats of all sim_expr_branch runs of each branch
+    """
+    programs = {}
+    rel_means = {}
+    branch_stats = {}
+    program_stats = {}
+    for branch, length, seed in zip(children, lengths, seeds):
+        rng = np.random.default_rng(seed)
+        stats = branch_stats[branch] = sut.RejectionStats()
+        runs = program_stats[branch] = sut.RejectionStats()
+        start_time = time.time()
+        # the candidate that came closest so far: the one with the lowest
+        # maximum above the cutoff and, below the cutoff, the one that
+        # diverges most from the accepted siblings
+        best = None
+        while True:
+            if stats.attempts >= max_branch_attempts:
+                stats.exhausted = True
+                break
+            stats.attempts += 1
+            # the fallback is reported once for the whole tree by
+            # simulate_lineage, also from process pool workers
+            with ins.stage("sim_expr_branch"):
+                branch_programs, run, filled = _expr_branch(
+                    length, modules, cutoff=intra_branch_tol, rng=rng)
+            runs.merge(run)
+            fell_back = run.exhausted
+            if parent_row is not None:
+                branch_programs = sut.bifurc_adjust(branch_programs, parent_row)
+            branch_means = np.dot(branch_programs, coefficients)
+            excess = max(np.max(branch_means) - rel_exp_cutoff, 0.)
+            fractions = None
+            closeness = (excess, 0.)
+            if excess == 0:
+                rel_means[branch] = branch_means
+                # the accepted siblings were already tested against each other
+                fractions = sut.divergence_from(branch, list(programs),
+                                                rel_means, genes)
+                closeness = (0., -np.min(fractions, initial=1.))
+            if best is None or closeness < best[0]:
+                best = (closeness, branch_programs, branch_means, fell_back)
+            if fractions is None:
+                stats.reject("cutoff")
+                continue
+            if np.all(fractions > inter_branch_tol):
+                break
+            stats.reject("divergence")
+        if stats.exhausted:
+            if fallback == "raise" or best is None:
+                stats.time = time.time() - start_time
+                msg = "Could not simulate branch %s within %i attempts (%r)" \
+                      % (branch, max_branch_attempts, stats)
+                raise RuntimeError(msg)
+            _, branch_programs, rel_means[branch], fell_back = best
+        programs[branch] = branch_programs
+        # only the accepted programs decide whether the branch is degraded
+        runs.exhausted = fell_back
+        stats.time = time.time() - start_time
+    return programs, rel_means, branch_stats, program_stats
+
+
+def sample_whole_tree_restricted(tree, alpha=0.2, beta=3, sparse=False,
+                                 chunk_size=CHUNK_SIZE, seed=None, workers=1,
+                                 backend="process", count_dtype=int,
+                                 amplification=None):
     """
     Bare-bones simulation where the lineage tree is simulated using default
-    parameters. Branches are assigned randomly if multiple are possible.
+    parameters. Branches are assigned randomly if multiple are possible. The
+    gene expression and the count parameters are drawn with their own streams
+    spawned from seed as well.
 
     Parameters
     ----------
@@ -290,10 +788,13 @@ def sample_whole_tree_restricted(tree, alpha=0.2, beta=3):
         Average alpha value
     beta: float, optional
         Average beta value
+    sparse, chunk_size, seed, workers, backend, count_dtype, amplification: optional
+        Shared sampling parameters, see "Sampling parameters" in the
+        module documentation
 
     Returns
     -------
-    expr_matrix: ndarray
+    expr_matrix: ndarray or csr_matrix
         Expression matrix of the differentiation
     sample_pt: ndarray
         Pseudotime values of the sampled cells
@@ -301,14 +802,29 @@ def sample_whole_tree_restricted(tree, alpha=0.2, beta=3):
         Library size scaling factor for each cell
     """
     sample_time = np.arange(0, tree.get_max_time())
-    tree.default_gene_expression()
-    alphas, betas = cm.generate_negbin_params(tree, mean_alpha=alpha, mean_beta=beta)
-
-    return _sample_data_at_times(tree, sample_time, alpha=alphas, beta=betas)
+    expr_seed, param_rng, sample_seed = None, None, None
+    if seed is not None:
+        expr_seed, param_seed, sample_seed = sut.seed_sequence(seed).spawn(3)
+        param_rng = np.random.default_rng(param_seed)
+    tree.default_gene_expression(seed=expr_seed)
+    alphas, betas = cm.generate_negbin_params(tree, mean_alpha=alpha, mean_beta=beta,
+                                              rng=param_rng)
+
+    cell_rng, count_seq = _split_seed(sample_seed)
+    return _sample_data_at_times(tree, sample_time, alpha=alphas, beta=betas,
+                                 sparse=sparse, chunk_size=chunk_size,
+                                 rng=cell_rng, count_seq=count_seq,
+                                 workers=workers,
+                                 backend=backend,
+                                 count_dtype=count_dtype,
+                                 amplification=amplification)
 
 
 def sample_pseudotime_series(tree, cells, series_points, point_std, alpha=0.3,
-                             beta=2, scale=True, scale_v=0.7):
+                             beta=2, scale=True, scale_v=0.7, sparse=False,
+                             chunk_size=CHUNK_SIZE, seed=None, workers=1,
+                             backend="process", count_dtype=int,
+                             amplification=None):
     """
     Simulate the expression matrix of a differentiation if the data came from
     a time series experiment.
@@ -342,10 +858,13 @@ def sample_pseudotime_series(tree, cells, series_points, point_std, alpha=0.3,
         Apply cell-specific library size factor to average gene expression
     scale_v: float, optional
         Variance for the drawing of scaling factors (library size) for each cell
+    sparse, chunk_size, seed, workers, backend, count_dtype, amplification: optional
+        Shared sampling parameters, see "Sampling parameters" in the
+        module documentation
 
     Returns
     -------
-    expr_matrix: ndarray
+    expr_matrix: ndarray or csr_matrix
         Expression matrix of the differentiation
     sample_pt: ndarray
         Pseudotime values of the sampled cells
@@ -354,20 +873,110 @@ def sample_pseudotime_series(tree, cells, series_points, point_std, alpha=0.3,
     scalings: ndarray
         Library size scaling factor for each cell
     """
+    cell_rng, count_seq = _split_seed(seed)
+    pseudotimes = _pseudotime_series_cells(tree, cells, series_points, point_std,
+                                           cell_rng)
+    return _sample_data_at_times(tree, pseudotimes, alpha=alpha, beta=beta,
+                                 scale=scale, scale_v=scale_v, sparse=sparse,
+                                 chunk_size=chunk_size, rng=cell_rng,
+                                 count_seq=count_seq, workers=workers,
+                                 backend=backend,
+                                 count_dtype=count_dtype,
+                                 amplification=amplification)
+
+
+def stream_pseudotime_series(tree, cells, series_points, point_std, alpha=0.3,
+                             beta=2, scale=True, scale_v=0.7,
+                             chunk_size=CHUNK_SIZE, seed=None, workers=1,
+                             backend="process", count_dtype=int,
+                             amplification=None):
+    """
+    Chunked version of sample_pseudotime_series. The pseudotime, branch and
+    library size of all cells are drawn immediately, but counts are only
+    sampled for chunk_size cells at a time, so that memory usage is
+    proportional to the chunk and not to the total number of cells.
+
+    Parameters
+    ----------
+    tree: Tree
+        A lineage tree
+    cells: list or int
+        If a list, then the number of cells to be sampled from each sample
+        point. If an integer, then the total number of cells to be sampled
+        (will be divided equally among all sample points)
+    series_points: list
+        A list of the pseudotime sample points
+    point_std: list or float
+        The standard deviation with which to sample around every sample point.
+        Use a list for differing std at each time point.
+    alpha: float or ndarray, optional
+        Parameter for the count-drawing distribution. Float if it is the same
+        for all genes, else an ndarray
+    beta: float or ndarray, optional
+        Parameter for the count-drawing distribution. Float if it is the same
+        for all genes, else an ndarray
+    scale: True, optional
+        Apply cell-specific library size factor to average gene expression
+    scale_v: float, optional
+        Variance for the drawing of scaling factors (library size) for each cell
+    chunk_size, seed, workers, backend, count_dtype, amplification: optional
+        Shared sampling parameters, see "Sampling parameters" in the
+        module documentation
+
+    Returns
+    -------
+    chunks: generator
+        Yields (expr_matrix, sample_pt, branches, scalings) for consecutive
+        blocks of cells. Concatenated, they are identical to the output of
+        sample_pseudotime_series for the same seed and chunk_size.
+    """
+    cell_rng, count_seq = _split_seed(seed)
+    pseudotimes = _pseudotime_series_cells(tree, cells, series_points, point_std,
+                                           cell_rng)
+    return _stream_data_at_times(tree, pseudotimes, alpha=alpha, beta=beta,
+                                 scale=scale, scale_v=scale_v,
+                                 chunk_size=chunk_size, rng=cell_rng,
+                                 count_seq=count_seq, workers=workers,
+                                 backend=backend,
+                                 count_dtype=count_dtype,
+                                 amplification=amplification)
+
+
+def _pseudotime_series_cells(tree, cells, series_points, point_std, rng=None):
+    """
+    Draw the pseudotimes of the cells of a time series experiment.
+
+    Parameters
+    ----------
+    tree: Tree
+        A lineage tree
+    cells: list or int
+        The number of cells per sample point or the total number of cells
+    series_points: list
+        A list of the pseudotime sample points
+    point_std: list or float
+        The standard deviation with which to sample around every sample point
+    rng: numpy.random.Generator, optional
+        The random number generator to use. If None, the global numpy random
+        state is used
+
+    Returns
+    -------
+    pseudotimes: ndarray
+        Pseudotime values of the sampled cells
+    """
     series_points, cells, point_std = sut.process_timeseries_input(
         series_points, cells, point_std)
     pseudotimes = []
 
     max_time = tree.get_max_time()
     for t, n, var in zip(series_points, cells, point_std):
-        times_around_t = draw_times(t, n, max_time, var)
+        times_around_t = draw_times(t, n, max_time, var, rng)
         pseudotimes.extend(times_around_t)
-    pseudotimes = np.array(pseudotimes)
-    return _sample_data_at_times(tree, pseudotimes, alpha=alpha, beta=beta,
-                                 scale=scale, scale_v=scale_v)
+    return np.array(pseudotimes)
 
 
-def draw_times(timepoint, no_cells, max_time, var=4):
+def draw_times(timepoint, no_cells, max_time, var=4, rng=None):
     """
     Draw cell pseudotimes around a certain sample time point under the
     assumption that in an asynchronously differentiating population cells are
@@ -388,20 +997,27 @@ def draw_times(timepoint, no_cells, max_time, var=4):
     var: float, optional
         Variance of the normal distribution we use to draw pseudotime points.
         In the experiment metaphor this parameter controls synchronicity.
+    rng: numpy.random.Generator, optional
+        The random number generator to use. If None, the global numpy random
+        state is used.
 
     Returns
     -------
     sample_pt: int array
         Pseudotime points around <timepoint>.
     """
-    sample_pt = sp.stats.norm.rvs(loc=timepoint, scale=var, size=no_cells)
+    sample_pt = sp.stats.norm.rvs(loc=timepoint, scale=var, size=no_cells,
+                                  random_state=rng)
     sample_pt = sample_pt.astype(int)
     sample_pt[sample_pt < 0] = 0
     sample_pt[sample_pt >= max_time] = max_time - 1
     return sample_pt
 
 
-def sample_density(tree, no_cells, alpha=0.3, beta=2, scale=True, scale_v=0.7):
+def sample_density(tree, no_cells, alpha=0.3, beta=2, scale=True, scale_v=0.7,
+                   sparse=False, chunk_size=CHUNK_SIZE, seed=None, workers=1,
+                   backend="process", count_dtype=int,
+                   amplification=None):
     """
     Use cell density along the lineage tree to sample pseudotime/branch pairs
     for the expression matrix.
@@ -422,10 +1038,13 @@ def sample_density(tree, no_cells, alpha=0.3, beta=2, scale=True, scale_v=0.7):
         Apply cell-specific library size factor to average gene expression
     scale_v: float, optional
         Variance for the drawing of scaling factors (library size) for each cell
+    sparse, chunk_size, seed, workers, backend, count_dtype, amplification: optional
+        Shared sampling parameters, see "Sampling parameters" in the
+        module documentation
 
     Returns
     -------
-    expr_matrix: ndarray
+    expr_matrix: ndarray or csr_matrix
         Expression matrix of the differentiation
     sample_pt: ndarray
         Pseudotime values of the sampled cells
@@ -434,29 +1053,95 @@ def sample_density(tree, no_cells, alpha=0.3, beta=2, scale=True, scale_v=0.7):
     scalings: ndarray
         Library size scaling factor for each cell
     """
-    bt = tree.branch_times()
+    cell_rng, count_seq = _split_seed(seed)
+    sample_time, sample_branches = _density_cells(tree, no_cells, cell_rng)
+    return _sample_data_at_times(tree, sample_time, alpha=alpha, beta=beta,
+                                 branches=sample_branches, scale=scale,
+                                 scale_v=scale_v, sparse=sparse,
+                                 chunk_size=chunk_size, rng=cell_rng,
+                                 count_seq=count_seq, workers=workers,
+                                 backend=backend,
+                                 count_dtype=count_dtype,
+                                 amplification=amplification)
+
+
+def stream_density(tree, no_cells, alpha=0.3, beta=2, scale=True, scale_v=0.7,
+                   chunk_size=CHUNK_SIZE, seed=None, workers=1,
+                   backend="process", count_dtype=int,
+                   amplification=None):
+    """
+    Chunked version of sample_density. The pseudotime, branch and library size
+    of all cells are drawn immediately, but counts are only sampled for
+    chunk_size cells at a time, so that memory usage is proportional to the
+    chunk and not to the total number of cells.
 
-    possible_pt = [np.arange(bt[b][0], bt[b][1] + 1) for b in tree.branches]
-    possible_branches = [[b] * tree.time[b] for b in tree.branches]
-    probabilities = [tree.density[b] for b in tree.branches]
+    Parameters
+    ----------
+    tree: Tree
+        A lineage tree
+    no_cells: int
+        Number of cells to sample
+    alpha: float or ndarray, optional
+        Parameter for the count-drawing distribution. Float if it is the same
+        for all genes, else an ndarray
+    beta: float or ndarray, optional
+        Parameter for the count-drawing distribution. Float if it is the same
+        for all genes, else an ndarray
+    scale: True, optional
+        Apply cell-specific library size factor to average gene expression
+    scale_v: float, optional
+        Variance for the drawing of scaling factors (library size) for each cell
+    chunk_size, seed, workers, backend, count_dtype, amplification: optional
+        Shared sampling parameters, see "Sampling parameters" in the
+        module documentation
+
+    Returns
+    -------
+    chunks: generator
+        Yields (expr_matrix, sample_pt, branches, scalings) for consecutive
+        blocks of cells. Concatenated, they are identical to the output of
+        sample_density for the same seed and chunk_size.
+    """
+    cell_rng, count_seq = _split_seed(seed)
+    sample_time, sample_branches = _density_cells(tree, no_cells, cell_rng)
+    return _stream_data_at_times(tree, sample_time, alpha=alpha, beta=beta,
+                                 branches=sample_branches, scale=scale,
+                                 scale_v=scale_v, chunk_size=chunk_size,
+                                 rng=cell_rng, count_seq=count_seq,
+                                 workers=workers,
+                                 backend=backend,
+                                 count_dtype=count_dtype,
+                                 amplification=amplification)
 
-    # make numpy arrays and flatten lists
-    probabilities = np.concatenate(probabilities)
-    possible_pt = np.concatenate(possible_pt)
-    possible_branches = np.concatenate(possible_branches)
 
-    # select according to density and take the selected elements
-    sample = random.choice(np.arange(len(probabilities)),
-                           size=no_cells, p=probabilities)
-    sample_time = possible_pt[sample]
-    sample_branches = possible_branches[sample]
+def _density_cells(tree, no_cells, rng=None):
+    """
+    Draw pseudotime/branch pairs according to the cell density of the tree.
 
-    return _sample_data_at_times(tree, sample_time, alpha=alpha, beta=beta,
-                                 branches=sample_branches, scale=scale,
-                                 scale_v=scale_v)
+    Parameters
+    ----------
+    tree: Tree
+        A lineage tree
+    no_cells: int
+        Number of cells to sample
+    rng: numpy.random.Generator, optional
+        The random number generator to use. If None, the global numpy random
+        state is used
 
+    Returns
+    -------
+    sample_time: ndarray
+        Pseudotime values of the sampled cells
+    sample_branches: ndarray
+        The branch to which each sampled cell belongs
+    """
+    return tree.density_sampler().sample(no_cells, rng)
 
-def sample_whole_tree(tree, n_factor, alpha=0.3, beta=2, scale=True, scale_v=0.7):
+
+def sample_whole_tree(tree, n_factor, alpha=0.3, beta=2, scale=True, scale_v=0.7,
+                      sparse=False, chunk_size=CHUNK_SIZE, seed=None, workers=1,
+                      backend="process", count_dtype=int,
+                      amplification=None):
     """
     Every possible pseudotime/branch pair on the lineage tree is sampled a
     number of times.
@@ -477,10 +1162,13 @@ def sample_whole_tree(tree, n_factor, alpha=0.3, beta=2, scale=True, scale_v=0.7
         Apply cell-specific library size factor to average gene expression
     scale_v: float, optional
         Variance for the drawing of scaling factors (library size) for each cell
+    sparse, chunk_size, seed, workers, backend, count_dtype, amplification: optional
+        Shared sampling parameters, see "Sampling parameters" in the
+        module documentation
 
     Returns
     -------
-    expr_matrix: ndarray
+    expr_matrix: ndarray or csr_matrix
         Expression matrix of the differentiation
     sample_pt: ndarray
         Pseudotime values of the sampled cells
@@ -489,14 +1177,87 @@ def sample_whole_tree(tree, n_factor, alpha=0.3, beta=2, scale=True, scale_v=0.7
     scalings: ndarray
         Library size scaling factor for each cell
     """
-    pseudotime, branches = cover_whole_tree(tree)
+    cell_rng, count_seq = _split_seed(seed)
+    pseudotime, branches = _whole_tree_cells(tree, n_factor)
+    return _sample_data_at_times(tree, pseudotime, alpha=alpha, beta=beta,
+                                 branches=branches, scale=scale,
+                                 scale_v=scale_v, sparse=sparse,
+                                 chunk_size=chunk_size, rng=cell_rng,
+                                 count_seq=count_seq, workers=workers,
+                                 backend=backend,
+                                 count_dtype=count_dtype,
+                                 amplification=amplification)
+
+
+def stream_whole_tree(tree, n_factor, alpha=0.3, beta=2, scale=True, scale_v=0.7,
+                      chunk_size=CHUNK_SIZE, seed=None, workers=1,
+                      backend="process", count_dtype=int,
+                      amplification=None):
+    """
+    Chunked version of sample_whole_tree. The library size of all cells is
+    drawn immediately, but counts are only sampled for chunk_size cells at a
+    time, so that memory usage is proportional to the chunk and not to the
+    total number of cells.
 
-    branches = np.repeat(branches, n_factor)
-    pseudotime = np.repeat(pseudotime, n_factor)
+    Parameters
+    ----------
+    tree: Tree
+        A lineage tree
+    n_factor: int
+        How many times each pseudotime/branch combination can be present
+    alpha: float or ndarray, optional
+        Parameter for the count-drawing distribution. Float if it is the same
+        for all genes, else an ndarray
+    beta: float or ndarray, optional
+        Parameter for the count-drawing distribution. Float if it is the same
+        for all genes, else an ndarray
+    scale: True, optional
+        Apply cell-specific library size factor to average gene expression
+    scale_v: float, optional
+        Variance for the drawing of scaling factors (library size) for each cell
+    chunk_size, seed, workers, backend, count_dtype, amplification: optional
+        Shared sampling parameters, see "Sampling parameters" in the
+        module documentation
 
-    return _sample_data_at_times(tree, pseudotime, alpha=alpha, beta=beta,
+    Returns
+    -------
+    chunks: generator
+        Yields (expr_matrix, sample_pt, branches, scalings) for consecutive
+        blocks of cells. Concatenated, they are identical to the output of
+        sample_whole_tree for the same seed and chunk_size.
+    """
+    cell_rng, count_seq = _split_seed(seed)
+    pseudotime, branches = _whole_tree_cells(tree, n_factor)
+    return _stream_data_at_times(tree, pseudotime, alpha=alpha, beta=beta,
                                  branches=branches, scale=scale,
-                                 scale_v=scale_v)
+                                 scale_v=scale_v, chunk_size=chunk_size,
+                                 rng=cell_rng, count_seq=count_seq,
+                                 workers=workers,
+                                 backend=backend,
+                                 count_dtype=count_dtype,
+                                 amplification=amplification)
+
+
+def _whole_tree_cells(tree, n_factor):
+    """
+    Repeat every pseudotime/branch pair of the lineage tree n_factor times.
+
+    Parameters
+    ----------
+    tree: Tree
+        A lineage tree
+    n_factor: int
+        How many times each pseudotime/branch combination is present
+
+    Returns
+    -------
+    pseudotime: ndarray
+        Pseudotime values of the cells
+    branches: ndarray
+        Branch assignments of the cells
+    """
+    pseudotime, branches = cover_whole_tree(tree)
+    return np.repeat(pseudotime, n_factor), np.repeat(branches, n_factor)
 
 
 def cover_whole_tree(tree):
@@ -531,7 +1292,10 @@ def cover_whole_tree(tree):
 
 
 def _sample_data_at_times(tree, sample_pt, branches=None, alpha=0.3, beta=2,
-                          scale=True, scale_v=0.7):
+                          scale=True, scale_v=0.7, sparse=False,
+                          chunk_size=CHUNK_SIZE, rng=None, count_seq=None,
+                          workers=1, backend="process", count_dtype=int,
+                          amplification=None):
     """
     Sample cells from the lineage tree for given pseudotimes. If branch
     assignments are not specified, cells will be randomly assigned to one of the
@@ -555,10 +1319,19 @@ def _sample_data_at_times(tree, sample_pt, branches=None, alpha=0.3, beta=2,
         Apply cell-specific library size factor to average gene expression
     scale_v: float, optional
         Variance for the drawing of scaling factors (library size) for each cell
+    sparse, chunk_size, workers, backend, count_dtype, amplification: optional
+        Shared sampling parameters, see "Sampling parameters" in the
+        module documentation
+    rng: numpy.random.Generator, optional
+        Random number generator for branches and scaling factors. If None, the
+        global numpy random state is used
+    count_seq: SeedSequence, optional
+        The seed sequence from which the streams for the counts of every chunk
+        are spawned. If None, it is seeded from the global numpy random state
 
     Returns
     -------
-    expr_matrix: ndarray
+    expr_matrix: ndarray or csr_matrix
         Expression matrix of the differentiation
     sample_pt: ndarray
         Pseudotime values of the sampled cells
@@ -567,24 +1340,177 @@ def _sample_data_at_times(tree, sample_pt, branches=None, alpha=0.3, beta=2,
     scalings: ndarray
         Library size scaling factor for each cell
     """
+    if count_seq is None:
+        count_seq = sut.seed_sequence()
+    branches, scalings, alpha, beta = _prepare_cells(tree, sample_pt, branches,
+                                                     alpha, beta, scale, scale_v,
+                                                     rng)
+    expr_matrix = _sample_counts(tree, sample_pt, branches, scalings, alpha, beta,
+                                 chunk_size, count_seq, workers, backend, sparse,
+                                 count_dtype, amplification)
+    return expr_matrix, sample_pt, branches, scalings
+
+
+def _stream_data_at_times(tree, sample_pt, branches=None, alpha=0.3, beta=2,
+                          scale=True, scale_v=0.7, chunk_size=CHUNK_SIZE,
+                          rng=None, count_seq=None, workers=1,
+                          backend="process", count_dtype=int,
+                          amplification=None):
+    """
+    Sample cells from the lineage tree for given pseudotimes, chunk by chunk.
+    Branch assignments and scaling factors are drawn for all cells before
+    returning, exactly like in _sample_data_at_times; counts are drawn lazily.
+
+    Parameters
+    ----------
+    tree: Tree
+        A lineage tree
+    sample_pt: ndarray
+        Pseudotime values for the cells to be sampled
+    branches: ndarray, optional
+        Branch assignment of the cells to be sampled
+    alpha: float or ndarray, optional
+        Parameter for the count-drawing distribution
+    beta: float or ndarray, optional
+        Parameter for the count-drawing distribution
+    scale: True, optional
+        Apply cell-specific library size factor to average gene expression
+    scale_v: float, optional
+        Variance for the drawing of scaling factors (library size) for each cell
+    chunk_size, workers, backend, count_dtype, amplification: optional
+        Shared sampling parameters, see "Sampling parameters" in the
+        module documentation
+    rng: numpy.random.Generator, optional
+        Random number generator for branches and scaling factors. If None, the
+        global numpy random state is used
+    count_seq: SeedSequence, optional
+        The seed sequence from which the streams for the counts of every chunk
+        are spawned. If None, it is seeded from the global numpy random state
+
+    Returns
+    -------
+    chunks: generator
+        Yields (expr_matrix, sample_pt, branches, scalings) for consecutive
+        blocks of cells
+    """
+    if count_seq is None:
+        count_seq = sut.seed_sequence()
+    branches, scalings, alpha, beta = _prepare_cells(tree, sample_pt, branches,
+                                                     alpha, beta, scale, scale_v,
+                                                     rng)
+    chunks = _draw_count_chunks(tree, sample_pt, branches, scalings, alpha, beta,
+                                chunk_size, count_seq, workers, backend,
+                                amplification=amplification)
+    return _iter_chunks(chunks, np.asarray(sample_pt), branches, scalings,
+                        count_dtype)
+
+
+def _iter_chunks(chunks, sample_pt, branches, scalings, count_dtype=int):
+    """
+    Generator behind _stream_data_at_times.
+    """
+    for start, counts in chunks:
+        cells = slice(start, start + len(counts))
+        yield (cm.compact_counts(counts, count_dtype), sample_pt[cells],
+               branches[cells], scalings[cells])
+
+
+@ins.timed("count_matrix")
+def _sample_counts(tree, pseudotime, branches, scalings, alpha, beta,
+                   chunk_size, count_seq, workers, backend, sparse,
+                   count_dtype=int, amplification=None):
+    """
+    Sample the complete expression matrix with _draw_count_chunks, either
+    into a preallocated array or as a sparse matrix that is assembled from
+    the chunks.
+    """
+    if sparse:
+        chunks = _draw_count_chunks(tree, pseudotime, branches, scalings, alpha,
+                                    beta, chunk_size, count_seq, workers, backend,
+                                    amplification=amplification)
+        blocks = [sps.csr_matrix(cm.compact_counts(counts, count_dtype))
+                  for start, counts in chunks]
+        if blocks:
+            return sps.vstack(blocks, format="csr")
+        return sps.csr_matrix((0, tree.G), dtype=count_dtype)
+
+    expr_matrix = np.zeros((len(branches), tree.G), dtype=count_dtype)
+    chunks = _draw_count_chunks(tree, pseudotime, branches, scalings, alpha, beta,
+                                chunk_size, count_seq, workers, backend,
+                                amplification=amplification, out=expr_matrix)
+    for start, counts in chunks:
+        if counts.base is expr_matrix:
+            continue
+        # the chunk did not fit into the output (or the output was promoted
+        # in the meantime), so promote the output as far as needed
+        counts = cm.compact_counts(counts, expr_matrix.dtype)
+        if counts.dtype != expr_matrix.dtype:
+            expr_matrix = expr_matrix.astype(counts.dtype)
+        expr_matrix[start:start + len(counts)] = counts
+    return expr_matrix
+
+
+def _split_seed(seed):
+    """
+    Derive the random streams of a sampler from its master seed.
+
+    Parameters
+    ----------
+    seed: None, int or SeedSequence
+        The master seed
+
+    Returns
+    -------
+    cell_rng: numpy.random.Generator or None
+        Random number generator for the selection of cells. None (use the
+        global numpy random state) if no seed was given
+    count_seq: SeedSequence
+        The seed sequence from which the count streams are spawned
+    """
+    if seed is None:
+        return None, sut.seed_sequence()
+    cell_seq, count_seq = sut.seed_sequence(seed).spawn(2)
+    return np.random.default_rng(cell_seq), count_seq
+
+
+@ins.timed("prepare_cells")
+def _prepare_cells(tree, sample_pt, branches, alpha, beta, scale, scale_v,
+                   rng=None):
+    """
+    Complete the information needed to sample counts for a group of cells:
+    pick branches if they are not given, draw library size factors and expand
+    scalar count parameters to all genes.
+
+    Returns
+    -------
+    branches: ndarray
+        The branch to which each cell belongs
+    scalings: ndarray
+        Library size scaling factor for each cell
+    alpha: ndarray
+        Parameter for the count-drawing distribution for each gene
+    beta: ndarray
+        Parameter for the count-drawing distribution for each gene
+    """
     no_cells = len(sample_pt)
     if np.shape(alpha) == ():
         alpha = [alpha] * tree.G
     if np.shape(beta) == ():
         beta = [beta] * tree.G
     if branches is None:
-        branches = sut.pick_branches(tree, sample_pt)
-    scalings = sut.calc_scalings(no_cells, scale, scale_v)
-    expr_matrix = draw_counts(tree, sample_pt, branches, scalings, alpha, beta)
-    return expr_matrix, sample_pt, branches, scalings
+        branches = sut.pick_branches(tree, sample_pt, rng)
+    scalings = sut.calc_scalings(no_cells, scale, scale_v, rng)
+    return np.asarray(branches), scalings, np.asarray(alpha), np.asarray(beta)
 
 
-def draw_counts(tree, pseudotime, branches, scalings, alpha, beta):
+def draw_counts(tree, pseudotime, branches, scalings, alpha, beta, seed=None,
+                workers=1, backend="process", chunk_size=CHUNK_SIZE,
+                count_dtype=int, amplification=None):
     """
     For all the cells in the lineage tree described by a given pseudotime and
-    branch assignment, sample UMI count values for all genes. Each cell is an
-    expression vector; the combination of all cell vectors builds the expression
-    matrix.
+    branch assignment, sample UMI (or amplified read) count values for all
+    genes. Each cell is an expression vector; the combination of all cell
+    vectors builds the expression matrix.
 
     Parameters
     ----------
@@ -602,30 +1528,223 @@ def draw_counts(tree, pseudotime, branches, scalings, alpha, beta):
     beta: float or ndarray
         Parameter for the count-drawing distribution. Float if it is the same
         for all genes, else an ndarray
+    seed, workers, backend, count_dtype, amplification, chunk_size: optional
+        Shared sampling parameters, see "Sampling parameters" in the
+        module documentation
 
     Returns
     -------
     expr_matrix: ndarray
         Expression matrix of the differentiation
     """
-    no_cells = len(branches)
+    return _sample_counts(tree, pseudotime, branches, scalings,
+                          np.asarray(alpha), np.asarray(beta), chunk_size,
+                          sut.seed_sequence(seed), workers, backend, sparse=False,
+                          count_dtype=count_dtype,
+                          amplification=amplification)
+
+
+def _draw_count_chunks(tree, pseudotime, branches, scalings, alpha, beta,
+                       chunk_size, count_seq, workers=1, backend="process",
+                       amplification=None, out=None):
+    """
+    Sample counts for chunk_size cells at a time. The means are packed and
+    the rows of all cells are looked up only once. Each chunk is drawn with
+    its own random stream spawned from count_seq; with more than one worker
+    the chunks are distributed over a process or thread pool and returned in
+    order. If out is given, every chunk is written into its rows of out.
+
+    Returns
+    -------
+    chunks: generator
+        Yields the index of the first cell of each chunk and its expression
+        matrix
+    """
+    if backend not in ("process", "thread"):
+        raise ValueError("backend must be 'process' or 'thread', not %s" % backend)
+    if amplification is not None:
+        amplification = cm.amplification_params(*amplification)
+    packed = _pack_means(tree)
+    rows = packed.rows(branches, pseudotime, tree.branch_times())
+    # the count parameters follow the precision of the means
+    scalings = np.asarray(scalings, dtype=packed.dtype)
+    alpha = np.asarray(alpha, dtype=packed.dtype)
+    beta = np.asarray(beta, dtype=packed.dtype)
+    starts = range(0, len(rows), chunk_size)
+    seeds = count_seq.spawn(len(starts))
+    shards = [(rows[start:start + chunk_size], scalings[start:start + chunk_size],
+               seed) for start, seed in zip(starts, seeds)]
+    targets = [None] * len(shards) if out is None else \
+              [out[start:start + chunk_size] for start in starts]
+
+    if workers == 1:
+        for start, shard, target in zip(starts, shards, targets):
+            yield start, _draw_shard(packed, alpha, beta, amplification, *shard,
+                                     out=target)
+        return
+
+    if backend == "thread":
+        # numpy releases the GIL for the bulk sampling and arithmetic, and
+        # every thread writes into its own rows of the output
+        pool = ThreadPoolExecutor(max_workers=workers)
+        jobs = (pool.submit(_draw_shard, packed, alpha, beta, amplification,
+                            *shard, out=target)
+                for shard, target in zip(shards, targets))
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers,
+                                   initializer=_init_shard_worker,
+                                   initargs=(packed, alpha, beta,
+                                             amplification))
+        jobs = (pool.submit(_draw_pool_shard, *shard) for shard in shards)
+
+    with pool:
+        # keep a bounded number of chunks in flight so that memory stays
+        # proportional to the chunk size
+        pending = deque()
+        for start, target, job in zip(starts, targets, jobs):
+            pending.append((start, target, job))
+            if len(pending) >= 2 * workers:
+                yield _finish_shard(*pending.popleft())
+        while pending:
+            yield _finish_shard(*pending.popleft())
+
+
+def _finish_shard(start, target, job):
+    """
+    Wait for a chunk sampled in a pool and copy it into its target rows.
+    """
+    counts = job.result()
+    if target is not None and counts is not target:
+        counts = _store_counts(counts, target)
+    return start, counts
+
+
+# the means and count parameters of a process pool worker
+_SHARD_STATE = {}
+
+
+def _init_shard_worker(packed, alpha, beta, amplification=None):
+    """
+    Initializer of the process pool workers of _draw_count_chunks.
+    """
+    _SHARD_STATE["packed"] = packed
+    _SHARD_STATE["alpha"] = alpha
+    _SHARD_STATE["beta"] = beta
+    _SHARD_STATE["amplification"] = amplification
+
+
+def _draw_pool_shard(rows, scalings, seed):
+    """
+    Sample the counts of one chunk of cells in a process pool worker.
+    """
+    return _draw_shard(_SHARD_STATE["packed"], _SHARD_STATE["alpha"],
+                       _SHARD_STATE["beta"], _SHARD_STATE["amplification"],
+                       rows, scalings, seed)
+
+
+def _draw_shard(packed, alpha, beta, amplification, rows, scalings, seed,
+                out=None):
+    """
+    Sample the counts of one chunk of cells.
+
+    Parameters
+    ----------
+    packed: BranchMeans or FactorizedMeans
+        The average gene expression of all branches
+    alpha: ndarray
+        Parameter for the count-drawing distribution
+    beta: ndarray
+        Parameter for the count-drawing distribution
+    amplification: tuple of float or None
+        Parameters (p_amp, r_amp) of the amplification of a single transcript,
+        or None for UMI counts
+    rows: ndarray
+        The packed row that belongs to each cell
+    scalings: ndarray
+        Library size scaling factor of each cell
+    seed: SeedSequence
+        Seed of the random stream of this chunk
+    out: ndarray, optional
+        Array into which the counts are written
+
+    Returns
+    -------
+    expr_matrix: ndarray
+        Expression matrix of the cells
+    """
+    with ins.stage("take_means", cells=len(rows)) as stage:
+        cell_avg_exp = packed.take(rows)
+        cell_avg_exp *= scalings[:, np.newaxis]
+        stage.size(bytes=cell_avg_exp.nbytes)
+    with ins.stage("sample_negbin", cells=len(rows), values=cell_avg_exp.size):
+        counts = _draw_from_means(cell_avg_exp, alpha, beta,
+                                  np.random.default_rng(seed), amplification)
+    if out is None:
+        return counts
+    return _store_counts(counts, out)
+
+
+def _store_counts(counts, target):
+    """
+    Copy counts into their target rows of the output, unless they do not fit
+    into its dtype; then the counts are returned as they are.
+    """
+    counts = cm.compact_counts(counts, target.dtype)
+    if counts.dtype != target.dtype:
+        return counts
+    target[:] = counts
+    return target
+
+
+def _draw_from_means(cell_avg_exp, alpha, beta, rng, amplification=None):
+    """
+    Sample UMI counts for cells with known (scaled) average gene expression.
+    If amplification is given, every transcript is amplified to a negative
+    binomial number of reads.
 
-    cell_avg_exp = np.zeros((no_cells, tree.G))
-    offsets = [tree.branch_times()[branch][0] for branch in branches]
-    cell_times = pseudotime - offsets
-    p_total = np.zeros(no_cells * tree.G)
-    r_total = np.zeros(no_cells * tree.G)
+    Parameters
+    ----------
+    cell_avg_exp: ndarray
+        Average expression of each gene in each cell
+    alpha: float or ndarray
+        Parameter for the count-drawing distribution
+    beta: float or ndarray
+        Parameter for the count-drawing distribution
+    rng: numpy.random.Generator
+        The random number generator to use
+    amplification: tuple of float, optional
+        Parameters (p_amp, r_amp) of the amplification of a single transcript
+
+    Returns
+    -------
+    expr_matrix: ndarray
+        Expression matrix of the cells
+    """
+    p_total, r_total = cm.get_pr_umi(a=np.asarray(alpha), b=np.asarray(beta),
+                                     m=cell_avg_exp)
+    counts = cm.sample_negbin(p_total, r_total, rng)
+    if amplification is None:
+        return counts
+    p_amp, r_amp = amplification
+    return cm.sample_negbin(p_amp, counts * r_amp, rng)
 
-    for n, time, branch in zip(np.arange(no_cells), cell_times, branches):
-        cell_avg_exp[n] = tree.means[branch][time] * scalings[n]
 
-    for cell in range(no_cells):
-        p, r = cm.get_pr_umi(a=alpha, b=beta, m=cell_avg_exp[cell])
-        p_total[cell * tree.G:(cell + 1) * tree.G] = p
-        r_total[cell * tree.G:(cell + 1) * tree.G] = r
+def _pack_means(tree):
+    """
+    The average gene expression of all branches in one contiguous array. If
+    the means of the tree are already packed (see Tree.pack_means) or
+    factorized, they are used as they are, otherwise a packed copy is made.
 
-    nbinom = sp.stats.nbinom(n=r_total, p=(1 - p_total))
-    expr_matrix = nbinom.rvs()
-    # custm = cm.my_negbin()
-    # expr_matrix = custm.rvs(p_total, r_total)
-    return expr_matrix.reshape((no_cells, tree.G))
+    Parameters
+    ----------
+    tree: Tree
+        A lineage tree
+
+    Returns
+    -------
+    packed: BranchMeans or FactorizedMeans
+        The packed average gene expression
+    """
+    if isinstance(tree.means, (tu.BranchMeans, tu.FactorizedMeans)):
+        return tree.means
+    return tu.BranchMeans.pack(tree.means, tree.branches)
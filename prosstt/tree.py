@@ -9,22 +9,34 @@ tree.
 """
 
 from collections import defaultdict
+from collections.abc import Mapping
+from types import MappingProxyType
 import numpy as np
 import pandas as pd
 import newick
+from prosstt import instrumentation as ins
 from prosstt import tree_utils as tu
 from prosstt import simulation as sim
 from prosstt import sim_utils as sut
 
+class _Children(dict):
+    """
+    Children of each branch; a leaf has no children.
+    """
+
+    def __missing__(self, key):
+        return ()
+
+
 class Tree(object):
     """
     Formalization of a lineage tree.
 
     Attributes
     ----------
-    topology: list of lists
-        Each nested list contains a connection from one branch to another
-    time: dict
+    topology: tuple of tuples
+        Each nested tuple contains a connection from one branch to another
+    time: Series
         The length of each branch in pseudotime units
     num_branches: int
         Total number of branches
@@ -34,14 +46,25 @@ class Tree(object):
         Total number of expression programs for the lineage tree
     G: int
         Total number of genes
-    means: Series
-        Average gene expression per gene per branch
+    means: dict or BranchMeans
+        Average gene expression per gene per branch. pack_means stores them
+        in one contiguous array
     branches: list
         List of the branch names
     root: str
         Name of the branch that contains the tree root
-    density: Series
+    density: mapping
         Density of cells at each part of the lineage tree
+
+    Notes
+    -----
+    The results of branch_times, paths, populate_timezone, as_dictionary,
+    get_parallel_branches, pseudotime_index and density_sampler are cached.
+    The cache is cleared whenever topology, time, root or density are
+    assigned. topology, time, density, paths, as_dictionary and
+    get_parallel_branches return read-only views of the values stored in the
+    tree, so modifying them in place raises an error; assign a new value
+    instead (e.g. tree.time = new_time).
     """
 
     # default values for when the user is not decided
@@ -56,6 +79,7 @@ class Tree(object):
                  G=def_genes,
                  density=None,
                  root=None):
+        self._cache = {}
         self.topology = topology
         self.time = pd.Series(time, name="time")
         self.num_branches = num_branches
@@ -79,6 +103,83 @@ class Tree(object):
         else:
             self.density = density
 
+    @property
+    def topology(self):
+        """
+        The connections between branches as a tuple of (parent, child) pairs.
+        Assign a new topology to change it.
+        """
+        return self._topology
+
+    @topology.setter
+    def topology(self, topology):
+        self._topology = tuple(tuple(pair) for pair in topology)
+        self.clear_cache()
+
+    @property
+    def time(self):
+        """
+        The length of each branch in pseudotime units. The Series is read-only;
+        assign new lengths to change them.
+        """
+        return self._time
+
+    @time.setter
+    def time(self, time):
+        time = pd.Series(time)
+        values = np.array(time.values)
+        values.flags.writeable = False
+        self._time = pd.Series(values, index=time.index, name="time",
+                               copy=False)
+        self.clear_cache()
+
+    @property
+    def root(self):
+        """
+        Name of the branch that contains the tree root.
+        """
+        return self._root
+
+    @root.setter
+    def root(self, root):
+        self._root = root
+        self.clear_cache()
+
+    @property
+    def density(self):
+        """
+        Density of cells at each pseudotime point of every branch. The mapping
+        and its arrays are read-only; assign a new density to change it.
+        """
+        return MappingProxyType(self._density)
+
+    @density.setter
+    def density(self, density):
+        self._density = {}
+        for branch, branch_density in density.items():
+            branch_density = np.array(branch_density, dtype=float)
+            branch_density.flags.writeable = False
+            self._density[branch] = branch_density
+        self.clear_cache()
+
+    def clear_cache(self):
+        """
+        Discard the cached results of the structural queries on the tree.
+        """
+        self._cache.clear()
+
+    def __getstate__(self):
+        # the cache is rebuilt on demand after unpickling
+        state = self.__dict__.copy()
+        state["_cache"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # unpickled arrays are writeable again, so store read-only copies
+        self.time = self._time
+        self.density = self._density
+
     @staticmethod
     def gen_random_topology(branch_points):
         """
@@ -135,27 +236,32 @@ class Tree(object):
         """
         total_time = 0
         density = {}
-        for branch_time in self.time.values:
+        for branch_time in self._time.values:
             total_time += branch_time
 
-        for k in self.time.keys():
-            density[k] = np.array([1. / total_time] * np.int(self.time[k]))
+        for k in self._time.keys():
+            density[k] = np.array([1. / total_time] * int(self._time[k]))
         return density
 
 
-    def add_genes(self, *args):
+    def add_genes(self, *args, dtype=None):
         """
         Sets the average gene expression trajectories of genes for all branches
         after performing a sanity check. Calls either _add_genes_from_relative
         or _add_genes_from_average.
+
+        The keyword argument dtype (e.g. numpy.float32) sets the floating
+        point type in which the means are stored; by default the type of the
+        input is kept. The count samplers compute in the precision of the
+        means.
         """
-        if len(args) == 1 and isinstance(args[0], dict):
-            self._add_genes_from_average(args[0])
+        if len(args) == 1 and isinstance(args[0], Mapping):
+            self._add_genes_from_average(args[0], dtype)
         if len(args) == 2 and isinstance(args[1], np.ndarray):
-            self._add_genes_from_relative(args[0], args[1])
+            self._add_genes_from_relative(args[0], args[1], dtype)
 
 
-    def _add_genes_from_relative(self, relative_means, base_gene_expr):
+    def _add_genes_from_relative(self, relative_means, base_gene_expr, dtype=None):
         """
         Sets the average gene expression trajectories of genes for all branches
         after performing a sanity check.
@@ -168,24 +274,28 @@ class Tree(object):
             relative_expression[b] has the dimensions time[b], G)
         base_gene_expr: ndarray
             Contains the base gene expression values for each gene.
+        dtype: dtype, optional
+            Floating point type of the stored means
         """
         average_expr = {}
         for i in self.branches:
             average_expr[i] = np.exp(relative_means[i]) * base_gene_expr
-        self._add_genes_from_average(average_expr)
+        self._add_genes_from_average(average_expr, dtype)
 
 
-    def _add_genes_from_average(self, average_expression):
+    def _add_genes_from_average(self, average_expression, dtype=None):
         """
         Sets the average gene expression trajectories of genes for all branches
         after performing a sanity check.
 
         Parameters
         ----------
-        average_expression: dict
+        average_expression: dict, BranchMeans or FactorizedMeans
             A dictionary of tables that contain average gene expression for
             each pseudotime point of every branch (ndarray
             average_expression[b] has the dimensions time[b], G)
+        dtype: dtype, optional
+            Floating point type of the stored means
         """
         # sanity check of dimensions so that in case a user messes up there is
         # no cryptic IndexOutOfBounds exception they have to trace.
@@ -194,16 +304,51 @@ class Tree(object):
                    the number of branches in the topology"
             raise ValueError(msg)
 
+        packed = isinstance(average_expression, (tu.BranchMeans, tu.FactorizedMeans))
+        if packed:
+            # avoid computing factorized means just to check their shape
+            shapes = average_expression.shapes()
+        else:
+            shapes = {b: average_expression[b].shape for b in average_expression}
         for branch in average_expression:
-            mean = average_expression[branch]
-            if not mean.shape == (self.time[branch], self.G):
+            if not shapes[branch] == (self._time[branch], self.G):
                 msg = "Branch " + branch + " was expected to have a shape " \
-                        + str((self.time[branch], self.G)) + " and instead is " \
-                        + str(mean.shape)
+                        + str((self._time[branch], self.G)) + " and instead is " \
+                        + str(shapes[branch])
                 raise ValueError(msg)
 
+        if dtype is not None:
+            if packed:
+                average_expression = average_expression.astype(dtype)
+            else:
+                average_expression = {b: np.asarray(average_expression[b], dtype=dtype)
+                                      for b in average_expression}
         self.means = average_expression
 
+    def pack_means(self, out=None):
+        """
+        Store the average gene expression of all branches in one contiguous
+        array of shape (total_time, G), with the branches in the order of
+        self.branches. Afterwards self.means is a BranchMeans, which still
+        returns the means of a branch when indexed by its name, but lets the
+        samplers gather the means of all cells with a single fancy index.
+
+        Parameters
+        ----------
+        out: ndarray, optional
+            Array of shape (total_time, G) that receives the means, e.g. a
+            numpy.memmap or an array backed by shared memory
+
+        Returns
+        -------
+        means: BranchMeans
+            The packed average gene expression
+        """
+        if self.means is None:
+            raise ValueError("The tree has no average gene expression to pack")
+        self.means = tu.BranchMeans.pack(self.means, self.branches, out=out)
+        return self.means
+
     def set_density(self, density):
         """
         Sets the density as a function of the pseudotime and the branching. If
@@ -216,15 +361,18 @@ class Tree(object):
             The density of each branch. For each branch b, len(density[b]) must
             equal tree.time[b].
         """
-        if not len(density) == self.branches:
+        if not len(density) == len(self.branches):
             msg = "The number of arrays in density must be equal to the number \
                   of branches in the topology"
             raise ValueError(msg)
-        for i, branch_density in enumerate(density):
-            if not len(branch_density) == self.time[i]:
-                msg = "Branch " + str(i) + " was expected to have a length " \
-                      + str((self.time[i], self.G)) + " and instead is " \
-                      + str(branch_density.shape)
+        for branch in self.branches:
+            if branch not in density:
+                raise ValueError("Branch " + str(branch) + " has no density")
+            branch_density = density[branch]
+            if not len(branch_density) == self._time[branch]:
+                msg = "Branch " + str(branch) + " was expected to have a length " \
+                      + str(self._time[branch]) + " and instead is " \
+                      + str(len(branch_density))
                 raise ValueError(msg)
         self.density = density
 
@@ -238,12 +386,12 @@ class Tree(object):
             Name of the starting node.
         """
         # find paths to leaves in dict:
-        tree_paths = self.paths(self.root)
+        tree_paths = self._paths(self.root)
 
         total_lengths = np.zeros(len(tree_paths))
 
         for i, path in enumerate(tree_paths):
-            path_length = [self.time[branch] for branch in path]
+            path_length = [self._time[branch] for branch in path]
             total_lengths[i] = np.sum(path_length)
 
         return int(np.max(total_lengths))
@@ -255,13 +403,24 @@ class Tree(object):
 
         Returns
         -------
-        dict
-            The topology of the tree in dictionary form.
+        mapping
+            The topology of the tree in dictionary form, read-only. The
+            children of every branch are a tuple; leaves do not appear as keys
+            but have an empty tuple of children.
         """
-        treedict = defaultdict(list)
-        for branch_pair in self.topology:
-            treedict[branch_pair[0]].append(branch_pair[1])
-        return treedict
+        return MappingProxyType(self._as_dictionary())
+
+    def _as_dictionary(self):
+        """
+        Cached as_dictionary with tuples of children.
+        """
+        if "as_dictionary" not in self._cache:
+            treedict = {}
+            for branch_pair in self._topology:
+                treedict.setdefault(branch_pair[0], []).append(branch_pair[1])
+            self._cache["as_dictionary"] = _Children((k, tuple(v))
+                                                     for k, v in treedict.items())
+        return self._cache["as_dictionary"]
 
     def paths(self, start):
         """
@@ -274,24 +433,25 @@ class Tree(object):
 
         Returns
         -------
-        rooted_paths: int array
-            An array that contains all paths from the starting point to all
-            tree leaves.
-        """
-        # make a list of all possible paths through the tree
-        # and calculate the length of those paths, then keep max
-        # first take topology and make it a dictionary:
-        treedict = self.as_dictionary()
-        if not treedict[start]:
-            return [[start]]
-        else:
-            rooted_paths = []
-            root = [start]
-            for node in treedict[start]:
-                usable = self.paths(node)
-                for path in usable:
-                    rooted_paths.append(root + path)
-            return rooted_paths
+        rooted_paths: tuple of tuples
+            All paths from the starting point to all tree leaves.
+        """
+        return self._paths(start)
+
+    def _paths(self, start):
+        """
+        Cached paths as a tuple of tuples.
+        """
+        key = ("paths", start)
+        if key not in self._cache:
+            children = self._as_dictionary().get(start, ())
+            if not children:
+                rooted_paths = ((start,),)
+            else:
+                rooted_paths = tuple((start,) + path for node in children
+                                     for path in self._paths(node))
+            self._cache[key] = rooted_paths
+        return self._cache[key]
 
     def populate_timezone(self):
         """
@@ -304,17 +464,22 @@ class Tree(object):
 
         Returns
         -------
-        timezone: int array
-            Array of length total_time, contains the timezone information for
-            each pseudotime point.
-        updated_Ts: int array
-            Converts from relative time to absolute time: given
-            Ts=[25,25,25,25,25] branch 0 starts at pseudotime 0, but branches 1
-            and 2 start at pseudotime 25 and branches 3,4 at pseudotime 50.
+        timezone: list of lists
+            The first and last pseudotime point of each timezone.
+        """
+        if "populate_timezone" not in self._cache:
+            timezone = tuple((int(zone[0]), int(zone[1]))
+                             for zone in self._populate_timezone())
+            self._cache["populate_timezone"] = timezone
+        return [list(zone) for zone in self._cache["populate_timezone"]]
+
+    def _populate_timezone(self):
+        """
+        Computes the timezones of the tree; see populate_timezone.
         """
         res = []
-        tpaths = self.paths(self.root)
-        stacks = [self.morph_stack(self.time[x].tolist()) for x in tpaths]
+        tpaths = self._paths(self.root)
+        stacks = [self.morph_stack(self._time[list(x)].tolist()) for x in tpaths]
 
         while stacks:
             lpaths = len(stacks)
@@ -349,19 +514,97 @@ class Tree(object):
         Examples
         --------
         >>> from prosstt.tree import Tree
-        >>> t = Tree.from_topology([[0,1], [0,2]])
+        >>> t = Tree()
         >>> t.branch_times()
-        defaultdict(<class 'list'>, {0: [0, 39], 1: [40, 79], 2: [40, 79]})
+        defaultdict(<class 'list'>, {'A': [0, 39], 'B': [40, 79], 'C': [40, 79]})
         """
         branch_time = defaultdict(list)
-
-        branch_time[self.root] = [0, self.time[self.root] - 1]
-        for branch_pair in self.topology:
-            # the start time of b[1] is the end time of b[0]
-            b0_end = branch_time[branch_pair[0]][1]
-            branch_time[branch_pair[1]] = [b0_end + 1, b0_end + self.time[branch_pair[1]]]
+        for branch, (start, end) in self._branch_times().items():
+            branch_time[branch] = [start, end]
         return branch_time
 
+    def _branch_times(self):
+        """
+        Cached branch_times with (start, end) tuples.
+        """
+        if "branch_times" not in self._cache:
+            branch_time = {}
+            branch_time[self.root] = (0, int(self._time[self.root]) - 1)
+            for branch_pair in self._topology:
+                # the start time of b[1] is the end time of b[0]
+                b0_end = branch_time[branch_pair[0]][1]
+                branch_time[branch_pair[1]] = (b0_end + 1,
+                                               b0_end + int(self._time[branch_pair[1]]))
+            self._cache["branch_times"] = branch_time
+        return self._cache["branch_times"]
+
+    def pseudotime_index(self):
+        """
+        Lookup table for assigning cells at integer pseudotime points to
+        branches according to the density.
+
+        The candidate branches of all pseudotime points are stored in order of
+        pseudotime. The key of every candidate is its pseudotime plus the
+        cumulative density of the candidates up to and including it,
+        normalized to 1 within the pseudotime point. A cell at pseudotime t
+        with a uniform variate u in [0, 1) belongs to the first candidate
+        whose key is larger than t + u.
+
+        Returns
+        -------
+        keys: ndarray
+            The lookup key of each candidate
+        owners: ndarray
+            The position in self.branches of each candidate
+        ends: ndarray
+            For each pseudotime point, the position after its last candidate
+        has_mass: ndarray
+            For each pseudotime point, whether its total density is positive
+        """
+        if "pseudotime_index" not in self._cache:
+            bt = self._branch_times()
+            pseudotime = np.concatenate([np.arange(bt[b][0], bt[b][1] + 1)
+                                         for b in self.branches])
+            owners = np.concatenate([np.full(self._time[b], i)
+                                     for i, b in enumerate(self.branches)])
+            density = np.concatenate([self._density[b] for b in self.branches])
+
+            order = np.argsort(pseudotime, kind="stable")
+            pseudotime, owners, density = pseudotime[order], owners[order], density[order]
+            starts = np.flatnonzero(np.diff(pseudotime, prepend=-1))
+            ends = np.append(starts[1:], len(pseudotime))
+            totals = np.add.reduceat(density, starts)
+            has_mass = totals > 0
+
+            sizes = ends - starts
+            cumulative = np.cumsum(density)
+            before = np.repeat(cumulative[starts] - density[starts], sizes)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                cumulative = (cumulative - before) / np.repeat(totals, sizes)
+            cumulative[np.repeat(~has_mass, sizes)] = 1.
+            cumulative[ends - 1] = 1.
+            keys = pseudotime + cumulative
+
+            for arr in (keys, owners, ends, has_mass):
+                arr.flags.writeable = False
+            self._cache["pseudotime_index"] = (keys, owners, ends, has_mass)
+        return self._cache["pseudotime_index"]
+
+    def density_sampler(self):
+        """
+        Sampler of pseudotime/branch pairs according to the density of the
+        tree. It is built on the first call and reused until the density, the
+        topology or the branch lengths change.
+
+        Returns
+        -------
+        sampler: DensitySampler
+            Alias-method sampler for the density of the tree
+        """
+        if "density_sampler" not in self._cache:
+            self._cache["density_sampler"] = sut.DensitySampler(self)
+        return self._cache["density_sampler"]
+
     # stacks = [self.morph_stack(ntime[np.array(x)].tolist()) for x in tpaths]
     def morph_stack(self, stack):
         """
@@ -389,22 +632,68 @@ class Tree(object):
     def get_parallel_branches(self):
         """
         Find the branches that run in parallel (i.e. share a parent branch).
-        """
-        top_array = np.array(self.topology)
-        parallel = {}
-        for branch in np.unique(top_array[:, 0]):
-            matches = top_array[:, 0] == branch
-            parallel[branch] = top_array[matches, 1]
-        return parallel
 
-    def default_gene_expression(self):
+        Returns
+        -------
+        parallel: mapping
+            Read-only dictionary from each parent branch to a read-only array
+            of its children.
+        """
+        if "get_parallel_branches" not in self._cache:
+            top_array = np.array(self._topology)
+            parallel = {}
+            for branch in np.unique(top_array[:, 0]):
+                matches = top_array[:, 0] == branch
+                parallel[branch] = top_array[matches, 1]
+                parallel[branch].flags.writeable = False
+            self._cache["get_parallel_branches"] = parallel
+        return MappingProxyType(self._cache["get_parallel_branches"])
+
+    @ins.timed("default_gene_expression")
+    def default_gene_expression(self, dtype=None, lazy=False, seed=None):
         """
         Wrapper that simulates average gene expression values along the lineage
         tree by calling appropriate functions with default parameters.
-        """
-        relative_expr, walks, coefficients = sim.simulate_lineage(self, a=0.05)
-        gene_scale = sut.simulate_base_gene_exp(self, relative_expr)
+
+        Parameters
+        ----------
+        dtype: dtype, optional
+            Floating point type of the stored means, e.g. numpy.float32 to
+            halve their memory. Defaults to float64
+        lazy: bool, optional
+            Store only the expression programs, their coefficients and the gene
+            scale as a FactorizedMeans instead of the average expression of
+            every gene at every pseudotime point. Mean rows are then computed
+            when cells are sampled
+        seed: None, int or SeedSequence, optional
+            Master seed of the simulation. If None, the global numpy random
+            state is used
+
+        Notes
+        -----
+        lazy only shrinks the means that are kept afterwards. The simulation
+        itself still needs the relative expression of every gene at every
+        pseudotime point: simulate_lineage checks rel_exp_cutoff and the
+        divergence of sibling branches on it and returns it, and
+        simulate_base_gene_exp derives the gene scale from it. The peak memory
+        of this method is therefore that of the materialized means in either
+        case; so is that of _add_genes_from_relative, which always
+        materializes.
+        """
+        lineage_seed, base_rng = None, None
+        if seed is not None:
+            lineage_seed, base_seed = sut.seed_sequence(seed).spawn(2)
+            base_rng = np.random.default_rng(base_seed)
+        relative_expr, walks, coefficients = sim.simulate_lineage(
+            self, a=0.05, dtype=dtype, seed=lineage_seed)
+        gene_scale = sut.simulate_base_gene_exp(self, relative_expr,
+                                                rng=base_rng)
+        if lazy:
+            means = tu.FactorizedMeans.pack(walks, coefficients, gene_scale,
+                                            self.branches)
+            self.add_genes(means, dtype=dtype)
+            return
         average_expr = {}
         for branch in self.branches:
             average_expr[branch] = np.exp(relative_expr[branch]) * gene_scale
-        self.add_genes(average_expr)
+        self.add_genes(average_expr, dtype=dtype)
@@ -4,6 +4,8 @@
 This module contains utility functions for the Tree class.
 """
 
+from collections.abc import Mapping
+
 import numpy as np
 
 def parse_newick(newick_tree, def_time):
@@ -41,7 +43,7 @@ def parse_newick(newick_tree, def_time):
         if node.length == 0:
             time.update({node.name: def_time})
         else:
-            time.update({node.name: np.int(node.length)})
+            time.update({node.name: int(node.length)})
 
         if not node.descendants:
             continue
@@ -53,3 +55,319 @@ def parse_newick(newick_tree, def_time):
         if node.ancestor is None:
             root = node.name
     return topology, time, branches, branch_points, root
+
+
+class _PackedBranches(Mapping):
+    """
+    Base class of mappings from branch names to rows of one array in which
+    the rows of all branches are stored one after the other. Subclasses set
+    the offsets and lengths attributes.
+    """
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def rows(self, branches, pseudotime, branch_times):
+        """
+        The packed rows that belong to cells, so that take(rows) gives the
+        means of all cells at once.
+
+        Parameters
+        ----------
+        branches: ndarray
+            Branch assignments for all cells
+        pseudotime: ndarray
+            Pseudotime values for all cells
+        branch_times: dict
+            The pseudotime at which each branch starts and ends, as returned
+            by Tree.branch_times
+
+        Returns
+        -------
+        rows: ndarray
+            The packed row that belongs to each cell. A ValueError is raised
+            if the pseudotime of a cell lies outside of its branch
+        """
+        names, inverse = np.unique(branches, return_inverse=True)
+        inverse = inverse.ravel()
+        pseudotime = np.asarray(pseudotime, dtype=int)
+        first = np.array([branch_times[b][0] for b in names], dtype=int)
+        last = np.array([branch_times[b][1] for b in names], dtype=int)
+        outside = (pseudotime < first[inverse]) | (pseudotime > last[inverse])
+        if np.any(outside):
+            cell = np.flatnonzero(outside)[0]
+            msg = "Pseudotime " + str(pseudotime[cell]) + " is outside of " \
+                  + "branch " + str(names[inverse[cell]])
+            raise ValueError(msg)
+        # shift the offset of each branch by its starting pseudotime, so that
+        # adding the pseudotime of a cell gives its row
+        starts = np.array([self.offsets[b] for b in names], dtype=int) - first
+        return starts[inverse] + pseudotime
+
+
+class BranchMeans(_PackedBranches):
+    """
+    Average gene expression of all branches of a lineage tree, packed into one
+    contiguous array of shape (total_time, G). The branches are stored one
+    after the other and indexing by branch name returns a view of the rows of
+    that branch, so a BranchMeans can be used wherever the dictionary of
+    arrays in Tree.means is expected. The views can be modified in place, but
+    branches cannot be replaced or added.
+
+    Parameters
+    ----------
+    data: ndarray
+        The average gene expression of all branches, one after the other
+    offsets: dict
+        The first row of each branch in data
+    lengths: dict
+        The number of rows of each branch in data
+
+    Attributes
+    ----------
+    data: ndarray
+        The packed average gene expression
+    offsets: dict
+        The first row of each branch in data
+    lengths: dict
+        The number of rows of each branch in data
+    """
+
+    def __init__(self, data, offsets, lengths):
+        self.data = data
+        self.offsets = dict(offsets)
+        self.lengths = dict(lengths)
+
+    @classmethod
+    def pack(cls, means, branches, out=None):
+        """
+        Pack a dictionary of average gene expression arrays.
+
+        Parameters
+        ----------
+        means: dict
+            The average gene expression of each branch, with dimensions
+            (time[b], G)
+        branches: list
+            The order in which the branches are stored
+        out: ndarray, optional
+            Array of shape (total_time, G) into which the means are copied,
+            e.g. a numpy.memmap or an array backed by shared memory. If None,
+            a new array is allocated
+
+        Returns
+        -------
+        packed: BranchMeans
+            The packed average gene expression
+        """
+        # look at shapes and types without computing lazy means
+        if isinstance(means, _PackedBranches):
+            shapes = means.shapes()
+            dtype = means.dtype
+        else:
+            shapes = {b: np.shape(means[b]) for b in branches}
+            dtype = np.result_type(*[means[b] for b in branches])
+        offsets = {}
+        lengths = {}
+        total = 0
+        for branch in branches:
+            offsets[branch] = total
+            lengths[branch] = shapes[branch][0]
+            total += lengths[branch]
+        genes = shapes[branches[0]][1]
+        if out is None:
+            out = np.empty((total, genes), dtype=dtype)
+        elif not out.shape == (total, genes):
+            msg = "out was expected to have a shape " + str((total, genes)) \
+                  + " and instead is " + str(out.shape)
+            raise ValueError(msg)
+        for branch in branches:
+            out[offsets[branch]:offsets[branch] + lengths[branch]] = means[branch]
+        return cls(out, offsets, lengths)
+
+    @property
+    def dtype(self):
+        """
+        The dtype of the means.
+        """
+        return self.data.dtype
+
+    def shapes(self):
+        """
+        The shape of the means of every branch, without creating any views.
+        """
+        return {b: (self.lengths[b], self.data.shape[1]) for b in self.offsets}
+
+    def astype(self, dtype):
+        """
+        The packed means with the given dtype; self is returned if the dtype
+        does not change.
+        """
+        if self.data.dtype == dtype:
+            return self
+        return BranchMeans(self.data.astype(dtype), self.offsets, self.lengths)
+
+    def take(self, rows):
+        """
+        The means of the given rows of data.
+        """
+        return self.data[rows]
+
+    def __getitem__(self, branch):
+        start = self.offsets[branch]
+        return self.data[start:start + self.lengths[branch]]
+
+
+class FactorizedMeans(_PackedBranches):
+    """
+    Lazy representation of the average gene expression of a lineage tree as
+    exp(programs . coefficients) * gene_scale. Only the T x K expression
+    programs of every branch, the K x G coefficients and the gene scale are
+    stored, and mean rows are computed when they are needed, e.g. only for the
+    rows that sampled cells fall on. With K programs this takes about K/G of
+    the memory of the materialized means.
+
+    Only the stored means are factorized: Tree.default_gene_expression still
+    simulates the relative expression of every branch in full (see there),
+    so the peak memory of building a FactorizedMeans is not reduced.
+
+    Indexing by branch name computes the means of that branch, so a
+    FactorizedMeans can be used wherever the dictionary of arrays in
+    Tree.means is expected.
+
+    Parameters
+    ----------
+    programs: ndarray
+        The expression programs of all branches, one after the other, with
+        shape (total_time, K)
+    coefficients: ndarray
+        Contribution weight of each expression program for each gene, with
+        shape (K, G)
+    gene_scale: ndarray
+        Base expression of each gene
+    offsets: dict
+        The first row of each branch in programs
+    lengths: dict
+        The number of rows of each branch in programs
+    dtype: dtype, optional
+        The floating point type of the computed means
+
+    Attributes
+    ----------
+    programs: ndarray
+        The packed expression programs
+    coefficients: ndarray
+        The coefficients of the expression programs
+    gene_scale: ndarray
+        Base expression of each gene
+    offsets: dict
+        The first row of each branch in programs
+    lengths: dict
+        The number of rows of each branch in programs
+    """
+
+    def __init__(self, programs, coefficients, gene_scale, offsets, lengths,
+                 dtype=np.float64):
+        self.programs = programs
+        self.coefficients = coefficients
+        self.gene_scale = gene_scale
+        self.offsets = dict(offsets)
+        self.lengths = dict(lengths)
+        self._dtype = np.dtype(dtype)
+
+    @classmethod
+    def pack(cls, programs, coefficients, gene_scale, branches, dtype=np.float64):
+        """
+        Create a FactorizedMeans from the expression programs of each branch.
+
+        Parameters
+        ----------
+        programs: dict
+            The expression programs of each branch, with dimensions
+            (time[b], K)
+        coefficients: ndarray
+            Contribution weight of each expression program for each gene
+        gene_scale: ndarray
+            Base expression of each gene
+        branches: list
+            The order in which the branches are stored
+        dtype: dtype, optional
+            The floating point type of the computed means
+
+        Returns
+        -------
+        means: FactorizedMeans
+            The lazy average gene expression
+        """
+        packed = BranchMeans.pack(programs, branches)
+        return cls(packed.data, coefficients, np.asarray(gene_scale),
+                   packed.offsets, packed.lengths, dtype)
+
+    @property
+    def dtype(self):
+        """
+        The dtype of the computed means.
+        """
+        return self._dtype
+
+    def shapes(self):
+        """
+        The shape of the means of every branch, without computing them.
+        """
+        genes = self.coefficients.shape[1]
+        return {b: (self.lengths[b], genes) for b in self.offsets}
+
+    def astype(self, dtype):
+        """
+        The same means, computed in the given dtype.
+        """
+        return FactorizedMeans(self.programs, self.coefficients, self.gene_scale,
+                               self.offsets, self.lengths, dtype)
+
+    def take(self, rows, block_size=256):
+        """
+        Compute the means of the given rows. Every distinct row is computed
+        only once, block_size distinct rows at a time, and written straight
+        into the output, so that apart from the output only the means of one
+        block are held in memory.
+
+        Parameters
+        ----------
+        rows: ndarray
+            Rows of the packed programs, e.g. as returned by rows()
+        block_size: int, optional
+            The number of distinct rows that are computed at once
+
+        Returns
+        -------
+        means: ndarray
+            Average expression of all genes for each row
+        """
+        unique, inverse = np.unique(rows, return_inverse=True)
+        inverse = inverse.ravel()
+        out = np.empty((len(inverse), self.coefficients.shape[1]), dtype=self._dtype)
+        # the positions of the output grouped by distinct row
+        order = np.argsort(inverse, kind="stable")
+        starts = np.arange(0, len(unique), block_size)
+        bounds = np.append(np.searchsorted(inverse[order], starts), len(order))
+        for i, start in enumerate(starts):
+            means = self._compute(self.programs[unique[start:start + block_size]])
+            positions = order[bounds[i]:bounds[i + 1]]
+            out[positions] = means[inverse[positions] - start]
+        return out
+
+    def _compute(self, programs):
+        """
+        Turn rows of expression programs into average gene expression.
+        """
+        means = np.dot(programs, self.coefficients).astype(self._dtype, copy=False)
+        np.exp(means, out=means)
+        means *= self.gene_scale.astype(self._dtype, copy=False)
+        return means
+
+    def __getitem__(self, branch):
+        start = self.offsets[branch]
+        return self._compute(self.programs[start:start + self.lengths[branch]])
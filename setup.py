@@ -9,7 +9,7 @@ setup(
     packages=find_packages(),
     # scripts=['say_hello.py'],
 
-    install_requires=['numpy', 'scipy', 'pandas', 'matplotlib', 'newick'],
+    install_requires=['numpy>=1.17', 'scipy', 'pandas', 'matplotlib', 'newick'],
     python_requires=">=3.5",
     # metadata
     author="Nikolaos Papadopoulos, Johannes Soeding",
@@ -18,5 +18,6 @@ setup(
     license="GPL3",
     keywords="single-cell RNA sequencing simulation probabilistic tree",
     url="https://github.com/soedinglab/PROSSTT",
-    test_suite="nose.collector"
+    # the tests use pytest fixtures: run them with python -m pytest tests
+    tests_require=["pytest"]
 )
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Fixtures shared by the tests: the lineage tree that all tests simulate on.
+"""
+
+import numpy as np
+import pytest
+
+from prosstt import tree as tr
+
+NEWICK = "((D:30,E:20)B:50,C:40)A:35;"
+
+
+@pytest.fixture
+def make_tree():
+    """
+    Factory of the test tree. The global random state is seeded before the
+    tree is built, since the number of expression programs is drawn from it.
+    """
+    def make(genes=10, seed=0, **kwargs):
+        np.random.seed(seed)
+        return tr.Tree.from_newick(NEWICK, genes=genes, **kwargs)
+    return make
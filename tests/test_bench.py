@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Tests of the benchmarks. The stages of a simulation stay within the
+bounds of bench.memory_bounds and a stage that exceeds its bound is
+reported.
+"""
+
+from prosstt import bench
+
+
+def test_memory_within_bounds():
+    results = bench.bench_memory(cells=3000, genes=200, depth=2)
+    assert results["exceeded"] == []
+    stages = results["stages"]
+    for name in ["count_matrix", "sample_negbin", "take_means",
+                 "default_gene_expression", "simulate_lineage",
+                 "simulate_base_gene_exp"]:
+        assert stages[name]["peak_bytes"] <= stages[name]["bound_bytes"]
+
+
+def test_memory_regression_is_reported():
+    memory_bounds = bench.memory_bounds
+
+    def tight_bounds(*args, **kwargs):
+        bounds = memory_bounds(*args, **kwargs)
+        # as if sampling the counts had started to allocate the whole output
+        bounds["sample_negbin"] = 1024
+        return bounds
+
+    bench.memory_bounds = tight_bounds
+    try:
+        results = bench.bench_memory(cells=1000, genes=100, depth=1)
+    finally:
+        bench.memory_bounds = memory_bounds
+    assert results["exceeded"] == ["sample_negbin"]
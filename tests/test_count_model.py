@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Tests of the samplers and likelihoods of prosstt.count_model.
+"""
+
+import numpy as np
+import numpy.testing as npt
+from scipy import sparse
+from scipy import stats
+
+from prosstt import count_model as cm
+
+
+def _params(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    means = np.exp(rng.normal(size=shape))
+    return cm.get_pr_umi(a=np.array(0.2), b=np.array(2.), m=means)
+
+
+def test_compact_counts():
+    counts = np.array([[0, 3], [200, 255]])
+    compact = cm.compact_counts(counts, np.uint8)
+    assert compact.dtype == np.uint8
+    npt.assert_array_equal(compact, counts)
+
+    counts = np.array([[0, 3], [256, 1000]])
+    promoted = cm.compact_counts(counts, np.uint8)
+    assert promoted.dtype == np.uint16
+    npt.assert_array_equal(promoted, counts)
+
+    same = np.arange(4, dtype=np.uint16)
+    assert cm.compact_counts(same) is same
+
+
+def test_sample_negbin_moments():
+    p, r = _params(5)
+    rng = np.random.default_rng(1)
+    draws = cm.sample_negbin(np.repeat(p[np.newaxis], 200000, axis=0),
+                             np.repeat(r[np.newaxis], 200000, axis=0), rng)
+    mean = p * r / (1 - p)
+    var = mean / (1 - p)
+    npt.assert_allclose(draws.mean(axis=0), mean, rtol=0.03)
+    npt.assert_allclose(draws.var(axis=0), var, rtol=0.06)
+
+
+def test_sample_negbin_degenerate_and_dtype():
+    p = np.array([0., 0.5], dtype=np.float32)
+    r = np.array([0., 2.], dtype=np.float32)
+    draws = cm.sample_negbin(np.tile(p, (1000, 1)), np.tile(r, (1000, 1)),
+                             np.random.default_rng(2))
+    assert np.all(draws[:, 0] == 0)
+    assert draws[:, 1].max() > 0
+
+
+def test_negbin_loglik_matches_scipy():
+    p, r = _params((6, 40), seed=3)
+    p[0, 4] = r[0, 4] = 0.
+    rng = np.random.default_rng(4)
+    counts = rng.poisson(3., size=(25, 40))
+    counts[:, 4] = 0
+    counts[0, 4] = 2
+    counts[1, 7] = 60
+    loglik = cm.negbin_loglik(counts, p, r, table_size=8, block_size=7)
+
+    expected = np.zeros((25, 6))
+    for model in range(6):
+        active = r[model] > 0
+        logpmf = stats.nbinom.logpmf(counts[:, active], r[model, active],
+                                     1 - p[model, active])
+        expected[:, model] = logpmf.sum(axis=1)
+        # the degenerate model only allows zero counts
+        expected[np.any(counts[:, ~active] > 0, axis=1), model] = -np.inf
+    npt.assert_allclose(loglik, expected, rtol=1e-10)
+    npt.assert_allclose(cm.negbin_loglik(sparse.csr_matrix(counts), p, r),
+                        expected, rtol=1e-10)
+
+
+def test_negbin_loglik_matches_lognegbin():
+    p, r = _params((3, 5), seed=5)
+    counts = np.array([[0, 1, 2, 30, 4], [7, 0, 0, 1, 19]])
+    loglik = cm.negbin_loglik(counts, p, r)
+    for cell in range(2):
+        for model in range(3):
+            expected = sum(np.real(cm.lognegbin(counts[cell, gene],
+                                                [p[model, gene], r[model, gene]]))
+                           for gene in range(5))
+            npt.assert_allclose(loglik[cell, model], expected, rtol=1e-10)
+
+
+def test_negbin_loglik_float_counts():
+    p, r = _params((3, 5), seed=6)
+    counts = np.array([[0, 1, 2, 30, 4], [7, 0, 0, 1, 19]])
+    expected = cm.negbin_loglik(counts, p, r)
+    npt.assert_array_equal(cm.negbin_loglik(counts.astype(np.float32), p, r),
+                           expected)
+    npt.assert_array_equal(cm.negbin_loglik(sparse.csr_matrix(counts * 1.), p,
+                                            r), expected)
+    npt.assert_raises(ValueError, cm.negbin_loglik, counts + 0.5, p, r)
+
+
+def _amplified_pmf(x, mu_amp, s2_amp, p, r, max_ksi=500):
+    """
+    The pmf of amplified reads, summed term by term with scipy.
+    """
+    p_amp, r_amp = cm.amplification_params(mu_amp, s2_amp)
+    total = stats.nbinom.pmf(0, r, 1 - p) * (x == 0)
+    for ksi in range(1, max_ksi + 1):
+        total += (stats.nbinom.pmf(ksi, r, 1 - p) *
+                  stats.nbinom.pmf(x, ksi * r_amp, 1 - p_amp))
+    return total
+
+
+def test_sum_negbin_logpmf_matches_scipy():
+    mu_amp, s2_amp = 3., 10.
+    p, r = _params(3, seed=6)
+    x = np.array([0, 1, 4, 17, 40])
+    logpmf = cm.sum_negbin_logpmf(x[:, np.newaxis], mu_amp, s2_amp, p, r)
+    assert logpmf.shape == (5, 3)
+    for gene in range(3):
+        expected = _amplified_pmf(x, mu_amp, s2_amp, p[gene], r[gene])
+        npt.assert_allclose(np.exp(logpmf[:, gene]), expected, rtol=1e-8)
+
+
+def test_sum_negbin_logpmf_entries_are_independent():
+    mu_amp, s2_amp = 3., 10.
+    p, r = _params(1, seed=7)
+    batch = cm.sum_negbin_logpmf([0, 5, 300], mu_amp, s2_amp, p[0], r[0])
+    alone = cm.sum_negbin_logpmf(0, mu_amp, s2_amp, p[0], r[0])
+    npt.assert_allclose(batch[0], alone, rtol=1e-14)
+    blocked = cm.sum_negbin_logpmf([0, 5, 300], mu_amp, s2_amp, p[0], r[0],
+                                   block_size=1)
+    npt.assert_allclose(batch, blocked, rtol=1e-14)
+
+
+def test_sum_negbin_logpmf_degenerate():
+    logpmf = cm.sum_negbin_logpmf([0, 1], 3., 10., 0., 0.)
+    npt.assert_array_equal(logpmf, [0., -np.inf])
+
+
+def test_sum_negbin_pmf_matches_entrywise():
+    p, r = _params(3, seed=10)
+    x = np.array([[0], [2], [9]])
+    mu_amp = np.array([[3.], [3.], [2.]])
+    s2_amp = np.array([[10.], [10.], [5.]])
+    pmf = cm.sum_negbin(name="sum_negbin").pmf(x, mu_amp, s2_amp, p, r)
+    assert pmf.shape == (3, 3)
+    for i in range(3):
+        for gene in range(3):
+            expected = np.exp(cm.sum_negbin_logpmf(x[i, 0], mu_amp[i, 0],
+                                                   s2_amp[i, 0], p[gene],
+                                                   r[gene]))
+            npt.assert_allclose(pmf[i, gene], expected, rtol=1e-12)
+
+
+def test_sample_amplified_matches_pmf():
+    mu_amp, s2_amp = 3., 10.
+    p, r = _params(1, seed=8)
+    draws = cm.sample_amplified(np.full(200000, p[0]), np.full(200000, r[0]),
+                                mu_amp, s2_amp, np.random.default_rng(9))
+    observed = np.bincount(draws, minlength=30)[:30] / len(draws)
+    expected = np.exp(cm.sum_negbin_logpmf(np.arange(30), mu_amp, s2_amp,
+                                           p[0], r[0]))
+    npt.assert_allclose(observed, expected, atol=5e-3)
+
+
+def test_amplification_params_validated():
+    npt.assert_raises(ValueError, cm.amplification_params, 3., 2.)
+    npt.assert_raises(ValueError, cm.amplification_params, 0., 2.)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Tests of prosstt.instrumentation: recording stages, the callbacks, nested
+stages and the no-op path while nothing is recorded.
+"""
+
+from prosstt import instrumentation as ins
+
+
+@ins.timed("double")
+def _double(value):
+    return 2 * value
+
+
+def test_nothing_recorded():
+    assert ins.stage("idle", cells=3) is ins._NULL_STAGE
+    with ins.stage("idle") as stage:
+        stage.size(cells=1)
+    assert _double(4) == 8
+    report = ins.start()
+    ins.stop(report)
+    with ins.stage("idle"):
+        pass
+    assert report.stages == {}
+    assert ins._ACTIVE == []
+
+
+def test_record_stages_and_sizes():
+    with ins.record() as report:
+        for cells in [10, 20]:
+            with ins.stage("sample", cells=cells) as stage:
+                stage.size(bytes=8 * cells)
+        assert _double(3) == 6
+    stats = report.stages["sample"]
+    assert stats.calls == 2
+    assert stats.sizes == {"cells": 30, "bytes": 240}
+    assert 0 <= stats.max_time <= stats.time
+    assert stats.peak_memory is None
+    assert report.stages["double"].calls == 1
+    assert report.as_dict()["double"]["calls"] == 1
+    assert "sample" in report.summary()
+    assert ins._ACTIVE == []
+
+
+def test_start_stop_and_concurrent_reports():
+    first = ins.start()
+    with ins.stage("one"):
+        pass
+    second = ins.start()
+    with ins.stage("two"):
+        pass
+    assert ins.stop(first) is first
+    with ins.stage("three"):
+        pass
+    ins.stop(second)
+    assert set(first.stages) == {"one", "two"}
+    assert set(second.stages) == {"two", "three"}
+
+
+def test_callback_arguments():
+    calls = []
+    with ins.record(lambda name, elapsed, sizes: calls.append(name)):
+        with ins.stage("plain", cells=1):
+            pass
+    assert calls == ["plain"]
+
+    traced = []
+    with ins.record(lambda *args: traced.append(args), memory=True):
+        with ins.stage("traced"):
+            data = bytearray(2**20)
+        del data
+    name, elapsed, sizes, peak = traced[0]
+    assert name == "traced"
+    assert sizes == {}
+    assert peak >= 2**20
+
+
+def test_nested_stages():
+    with ins.record(memory=True) as report:
+        with ins.stage("outer"):
+            with ins.stage("inner"):
+                data = bytearray(2**20)
+            del data
+            with ins.stage("after"):
+                pass
+    stages = report.stages
+    assert stages["outer"].time >= stages["inner"].time
+    # the peak of the inner stage counts for the outer one too
+    assert stages["inner"].peak_memory >= 2**20
+    assert stages["outer"].peak_memory >= stages["inner"].peak_memory
+    assert stages["after"].peak_memory < 2**20
+    assert ins._MEMORY["frames"] == []
+
+
+def test_nested_frames_with_equal_values():
+    with ins.record(memory=True):
+        with ins.stage("outer") as outer:
+            with ins.stage("inner") as inner:
+                # a different frame with the same values
+                outer.frame[:] = inner.frame
+            assert ins._MEMORY["frames"] == [outer.frame]
+            assert ins._MEMORY["frames"][0] is outer.frame
+    assert ins._MEMORY["frames"] == []
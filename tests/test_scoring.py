@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Tests of prosstt.scoring: scoring cells against the points of a tree.
+"""
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+import scipy.sparse as sps
+
+from prosstt import scoring
+from prosstt import simulation as sim
+
+
+@pytest.fixture
+def sample(make_tree):
+    tree = make_tree(genes=30, seed=2)
+    tree.default_gene_expression()
+    counts, _, _, scalings = sim.sample_density(tree, 40, alpha=0.2, beta=2.,
+                                                seed=3)
+    return tree, counts, scalings
+
+
+def test_score_cells_per_cell_scaling(sample):
+    tree, counts, scalings = sample
+    scaling = np.round(scalings, 1)
+    loglik, branches, pseudotime = scoring.score_cells(tree, counts, 0.2, 2.,
+                                                       scaling=scaling)
+    for cell in [0, 7, 23]:
+        alone, _, _ = scoring.score_cells(tree, counts[cell:cell + 1], 0.2,
+                                          2., scaling=scaling[cell])
+        npt.assert_allclose(loglik[cell], alone[0], rtol=1e-12)
+    sparse, _, _ = scoring.score_cells(tree, sps.csr_matrix(counts), 0.2, 2.,
+                                       scaling=scaling)
+    npt.assert_allclose(loglik, sparse, rtol=1e-12)
+
+
+def test_score_cells_scalar_scaling_matches_constant_array(sample):
+    tree, counts, _ = sample
+    scalar, _, _ = scoring.score_cells(tree, counts, 0.2, 2., scaling=0.8)
+    array, _, _ = scoring.score_cells(tree, counts, 0.2, 2.,
+                                      scaling=np.full(len(counts), 0.8))
+    npt.assert_allclose(scalar, array, rtol=1e-12)
+
+
+def test_score_cells_scaling_shape(sample):
+    tree, counts, _ = sample
+    npt.assert_raises(ValueError, scoring.score_cells, tree, counts, 0.2, 2.,
+                      np.ones(len(counts) + 1))
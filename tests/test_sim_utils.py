@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Tests of prosstt.sim_utils: branch assignment, density sampling and the
+correlation of expression programs.
+"""
+
+import warnings
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+from scipy import stats
+
+from prosstt import sim_utils as sut
+from prosstt import simulation as sim
+
+
+@pytest.fixture
+def tree(make_tree):
+    tree = make_tree()
+    # an uneven density, so that the branches of a time point differ
+    density = {}
+    for branch in tree.branches:
+        density[branch] = np.linspace(1., 3., tree.time[branch])
+    density["C"] = density["C"] * 4
+    tree.set_density(density)
+    return tree
+
+
+def _branch_probabilities(tree, pseudotime):
+    """
+    The probability of every branch at a pseudotime, from the density.
+    """
+    times = tree.branch_times()
+    weights = {}
+    for branch in tree.branches:
+        start, end = times[branch]
+        if start <= pseudotime <= end:
+            weights[branch] = tree.density[branch][pseudotime - start]
+    total = sum(weights.values())
+    return {branch: weight / total for branch, weight in weights.items()}
+
+
+def test_pick_branches_matches_pick_branch(tree):
+    timezones = tree.populate_timezone()
+    assignments = sut.assign_branches(tree.branch_times(), timezones)
+    rng = np.random.default_rng(0)
+    for pseudotime in [0, 34, 35, 60, 80, 90, 110]:
+        cells = 4000
+        vectorized = sut.pick_branches(tree, [pseudotime] * cells, rng)
+        looped = np.array([sut.pick_branch(tree, pseudotime, timezones,
+                                           assignments, rng)
+                           for _ in range(cells)])
+        for branch, prob in _branch_probabilities(tree, pseudotime).items():
+            # both agree with the density within five standard errors
+            tol = 5 * np.sqrt(prob * (1 - prob) / cells) + 1e-12
+            assert abs(np.mean(vectorized == branch) - prob) <= tol
+            assert abs(np.mean(looped == branch) - prob) <= tol
+
+
+def test_pick_branches_single_candidate_is_deterministic(tree):
+    branches = sut.pick_branches(tree, np.arange(35))
+    assert np.all(branches == "A")
+
+
+def test_pick_branches_rejects_invalid_pseudotime(tree):
+    max_time = len(tree.pseudotime_index()[2])
+    npt.assert_raises(ValueError, sut.pick_branches, tree, [max_time])
+    npt.assert_raises(ValueError, sut.pick_branches, tree, [-1])
+
+    density = dict(tree.density)
+    for branch in ["B", "C"]:
+        density[branch] = density[branch].copy()
+        density[branch][5] = 0.
+    tree.set_density(density)
+    npt.assert_raises(ValueError, sut.pick_branches, tree, [40])
+    # neighbouring time points keep their density
+    sut.pick_branches(tree, [39, 41])
+
+
+def test_density_sampler_frequencies(tree):
+    sampler = sut.DensitySampler(tree)
+    cells = 400000
+    pseudotime, branches = sampler.sample(cells, np.random.default_rng(3))
+    times = tree.branch_times()
+    total = sum(np.sum(tree.density[b]) for b in tree.branches)
+    for branch in tree.branches:
+        start = times[branch][0]
+        picked = pseudotime[branches == branch] - start
+        observed = np.bincount(picked, minlength=tree.time[branch]) / cells
+        expected = np.asarray(tree.density[branch]) / total
+        tol = 5 * np.sqrt(expected * (1 - expected) / cells)
+        assert np.all(np.abs(observed - expected) <= tol)
+
+
+def test_density_sampler_skips_zero_density(tree):
+    density = dict(tree.density)
+    density["C"] = np.zeros(tree.time["C"])
+    tree.set_density(density)
+    pseudotime, branches = tree.density_sampler().sample(20000)
+    assert "C" not in set(branches)
+
+
+def test_pearson_between_programs_matches_scipy():
+    rng = np.random.default_rng(4)
+    prog1 = rng.normal(size=(30, 8))
+    prog2 = rng.normal(size=(25, 8)) + 0.5 * prog1[:25]
+    # constant columns, including non-zero constants
+    prog1[:, 2] = 0.
+    prog1[:, 3] = 0.7
+    prog2[:, 5] = 1. / 3.
+    pearson = sut.pearson_between_programs(8, prog1, prog2)
+
+    expected = np.zeros(8)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for gene in range(8):
+            expected[gene] = stats.pearsonr(prog1[:25, gene], prog2[:, gene])[0]
+    assert np.all(np.isnan(pearson[[2, 3, 5]]))
+    npt.assert_allclose(pearson, expected, rtol=1e-10, atol=1e-12)
+
+
+def test_pearson_between_programs_too_short():
+    prog = np.ones((1, 3))
+    npt.assert_raises(ValueError, sut.pearson_between_programs, 3, prog, prog)
+
+
+def _diverging_reference(branches, programs, genes, tol):
+    """
+    The divergence of every pair of branches, one pair at a time.
+    """
+    indices = sut.flat_order(len(branches))
+    diverging = np.zeros(len(indices), dtype=bool)
+    for index, i, j in indices:
+        pearson = sut.pearson_between_programs(genes, programs[branches[i]],
+                                               programs[branches[j]])
+        diverging[index] = np.sum(pearson < 0) / genes > tol
+    return diverging
+
+
+def test_diverging_parallel_matches_pairwise_reference():
+    rng = np.random.default_rng(5)
+    genes = 12
+    outcomes = set()
+    for case in range(60):
+        branches = ["b%i" % i for i in range(rng.integers(2, 6))]
+        programs = {b: rng.normal(size=(rng.integers(3, 20), genes + 2))
+                    for b in branches}
+        # constant columns, including non-zero constants
+        programs[branches[0]][:, 1] = 0.
+        programs[branches[-1]][:, 4] = 0.3
+        if case % 3 == 0:
+            # a pair that cannot diverge
+            programs[branches[-1]] = programs[branches[0]].copy()
+        tol = rng.choice([0.2, 0.4, 0.5])
+        expected = _diverging_reference(branches, programs, genes, tol)
+        diverging = sut.diverging_parallel(branches + [None], programs, genes,
+                                           tol)
+        npt.assert_array_equal(diverging, expected)
+        both = sut.all_diverging(branches + [None], programs, genes, tol)
+        assert both == np.all(diverging)
+        # the first branch against all others
+        fractions = sut.divergence_from(branches[0], branches[1:], programs,
+                                        genes)
+        npt.assert_array_equal(fractions > tol, expected[:len(branches) - 1])
+        outcomes.add(both)
+    # both the early exit and the full test were exercised
+    assert outcomes == {True, False}
+    single = {"A": np.ones((5, 3))}
+    assert sut.diverging_parallel(["A", None], single, 3) == [True]
+    assert sut.all_diverging(["A", None], single, 3)
+
+
+def test_rejection_stats_as_dict_plain_types():
+    stats = sut.RejectionStats()
+    other = sut.RejectionStats()
+    other.attempts = np.int64(4)
+    other.time = np.float64(0.5)
+    other.reject("cutoff", np.int64(3))
+    stats.merge(other)
+    result = stats.as_dict()
+    assert type(result["attempts"]) is int
+    assert type(result["time"]) is float
+    assert type(result["time_per_attempt"]) is float
+    assert type(result["failures"]["cutoff"]) is int
+    assert result["time_per_attempt"] == 0.125
+
+
+def test_random_partition_matches_per_value_draws():
+    np.random.seed(5)
+    groups = sut.random_partition(4, range(50))
+    np.random.seed(5)
+    expected = [[] for _ in range(4)]
+    for value in range(50):
+        expected[np.random.randint(4)].append(value)
+    assert groups == expected
+
+
+def test_simulate_base_gene_exp_bound_and_stats(make_tree):
+    tree = make_tree(genes=200, seed=7)
+    relative_means = sim.simulate_lineage(tree, seed=1, a=0.05)[0]
+    base, stats, redraws = sut.simulate_base_gene_exp(
+        tree, relative_means, abs_max=50, max_rounds=3, return_stats=True,
+        rng=np.random.default_rng(2))
+    highest = np.max(sut.max_relat_exp(tree, relative_means), axis=1)
+    assert np.all(base * highest <= 50 * (1 + 1e-12))
+    assert redraws.shape == (tree.G,)
+    assert np.max(redraws) <= 3
+    assert stats.failures["abs_max"] == redraws.sum()
+    assert stats.attempts == tree.G + redraws.sum()
+    assert stats.restarts == 0
+    assert stats.as_dict()["failures"]["abs_max"] == redraws.sum()
+    only_base = sut.simulate_base_gene_exp(tree, relative_means, abs_max=50,
+                                           max_rounds=3,
+                                           rng=np.random.default_rng(2))
+    npt.assert_array_equal(only_base, base)
+
+    # a gene that is never expressed is not bounded and does not warn
+    silent = {b: relative_means[b].copy() for b in tree.branches}
+    for branch in tree.branches:
+        silent[branch][:, 0] = -np.inf
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        base, _, redraws = sut.simulate_base_gene_exp(
+            tree, silent, abs_max=50, return_stats=True,
+            rng=np.random.default_rng(2))
+    assert np.isfinite(base[0])
+    assert redraws[0] == 0
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Tests of the count samplers in prosstt.simulation: reproducibility across
+workers and backends, chunked streaming and sparse output.
+"""
+
+import warnings
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+import scipy.sparse as sps
+
+from prosstt import sim_utils as sut
+from prosstt import simulation as sim
+from prosstt import tree_utils as tu
+
+
+@pytest.fixture
+def tree(make_tree):
+    tree = make_tree(genes=60, seed=1)
+    tree.default_gene_expression()
+    return tree
+
+
+def _assert_same_sample(first, second):
+    for one, other in zip(first, second):
+        npt.assert_array_equal(one, other)
+
+
+def test_workers_and_backends_agree(tree):
+    reference = sim.sample_density(tree, 700, seed=11, chunk_size=100)
+    for workers, backend in [(2, "process"), (2, "thread"), (3, "thread")]:
+        result = sim.sample_density(tree, 700, seed=11, chunk_size=100,
+                                    workers=workers, backend=backend)
+        _assert_same_sample(reference, result)
+
+
+def test_draw_counts_workers_agree(tree):
+    pseudotime = np.arange(0, 115, 2)
+    branches = np.array(["A"] * 18 + ["B"] * 25 + ["D"] * 15)
+    scalings = np.linspace(0.5, 1.5, len(pseudotime))
+    reference = sim.draw_counts(tree, pseudotime, branches, scalings, 0.2, 2.,
+                                seed=4, chunk_size=16)
+    for backend in ["process", "thread"]:
+        counts = sim.draw_counts(tree, pseudotime, branches, scalings, 0.2, 2.,
+                                 seed=4, chunk_size=16, workers=2,
+                                 backend=backend)
+        npt.assert_array_equal(reference, counts)
+
+
+def test_draw_counts_rejects_pseudotime_outside_branch(tree):
+    # A spans the pseudotime 0..34
+    npt.assert_raises(ValueError, sim.draw_counts, tree, [60], ["A"], [1.],
+                      0.2, 2.)
+    npt.assert_raises(ValueError, sim.draw_counts, tree, [34, 20], ["A", "B"],
+                      [1., 1.], 0.2, 2.)
+    counts = sim.draw_counts(tree, [34, 35], ["A", "B"], [1., 1.], 0.2, 2.)
+    assert counts.shape == (2, tree.G)
+
+
+def test_seed_reproducible(tree):
+    _assert_same_sample(sim.sample_density(tree, 300, seed=5),
+                        sim.sample_density(tree, 300, seed=5))
+    first = sim.sample_density(tree, 300, seed=5)[0]
+    second = sim.sample_density(tree, 300, seed=6)[0]
+    assert not np.array_equal(first, second)
+
+
+def test_sample_whole_tree_restricted_seed_reproducible(make_tree):
+    first = sim.sample_whole_tree_restricted(make_tree(genes=20), seed=5)
+    tree = make_tree(genes=20)
+    # a different global random state does not change the result
+    np.random.seed(3)
+    second = sim.sample_whole_tree_restricted(tree, seed=5)
+    _assert_same_sample(first, second)
+
+
+def test_stream_density_concatenates_to_sample_density(tree):
+    sample = sim.sample_density(tree, 550, seed=2, chunk_size=128)
+    chunks = list(sim.stream_density(tree, 550, seed=2, chunk_size=128))
+    assert [len(chunk[0]) for chunk in chunks] == [128] * 4 + [38]
+    for i, whole in enumerate(sample):
+        npt.assert_array_equal(np.concatenate([chunk[i] for chunk in chunks]),
+                               whole)
+
+
+def test_stream_pseudotime_series_concatenates(tree):
+    args = (tree, 300, [10, 60, 100], 3)
+    sample = sim.sample_pseudotime_series(*args, seed=8, chunk_size=70)
+    chunks = list(sim.stream_pseudotime_series(*args, seed=8, chunk_size=70))
+    for i, whole in enumerate(sample):
+        npt.assert_array_equal(np.concatenate([chunk[i] for chunk in chunks]),
+                               whole)
+
+
+def test_stream_whole_tree_concatenates(tree):
+    sample = sim.sample_whole_tree(tree, 2, seed=9, chunk_size=50)
+    chunks = list(sim.stream_whole_tree(tree, 2, seed=9, chunk_size=50))
+    for i, whole in enumerate(sample):
+        npt.assert_array_equal(np.concatenate([chunk[i] for chunk in chunks]),
+                               whole)
+
+
+def test_sparse_equals_dense(tree):
+    dense = sim.sample_density(tree, 400, seed=3, chunk_size=90)
+    sparse = sim.sample_density(tree, 400, seed=3, chunk_size=90, sparse=True)
+    assert sps.isspmatrix_csr(sparse[0])
+    npt.assert_array_equal(sparse[0].toarray(), dense[0])
+    for one, other in zip(dense[1:], sparse[1:]):
+        npt.assert_array_equal(one, other)
+
+    dense = sim.sample_whole_tree(tree, 1, seed=3)
+    sparse = sim.sample_whole_tree(tree, 1, seed=3, sparse=True)
+    npt.assert_array_equal(sparse[0].toarray(), dense[0])
+
+
+def test_count_dtype(tree):
+    wide = sim.sample_density(tree, 200, seed=7)[0]
+    narrow = sim.sample_density(tree, 200, seed=7, count_dtype=np.uint16)[0]
+    assert narrow.dtype == np.uint16
+    npt.assert_array_equal(wide, narrow)
+
+
+def test_diffusion_batch():
+    walks = sim.diffusion_batch(40, 7, np.random.default_rng(8))
+    assert walks.shape == (7, 40)
+    npt.assert_array_equal(walks[:, 0], 0.)
+    # every walk is different
+    assert len(np.unique(walks[:, 1])) == 7
+    again = sim.diffusion_batch(40, 7, np.random.default_rng(8))
+    npt.assert_array_equal(walks, again)
+
+    single = sim.diffusion(40, np.random.default_rng(9))
+    batch = sim.diffusion_batch(40, 1, np.random.default_rng(9))
+    npt.assert_array_equal(single, batch[0])
+
+    np.random.seed(10)
+    first = sim.diffusion_batch(25, 3)
+    np.random.seed(10)
+    npt.assert_array_equal(first, sim.diffusion_batch(25, 3))
+
+
+def test_sim_expr_branch_fallback_warns():
+    rng = np.random.default_rng(0)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        programs, stats = sim.sim_expr_branch(40, 50, cutoff=0.5,
+                                              return_stats=True, rng=rng)
+    assert programs.shape == (40, 50)
+    assert stats.exhausted
+    assert any(issubclass(w.category, RuntimeWarning) for w in caught)
+
+    npt.assert_raises(RuntimeError, sim.sim_expr_branch, 40, 50, cutoff=0.5,
+                      fallback="raise", rng=np.random.default_rng(0))
+
+
+def test_sim_expr_branch_respects_cutoff():
+    rng = np.random.default_rng(1)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        programs = sim.sim_expr_branch(40, 20, cutoff=0.5, rng=rng)
+    corr = np.corrcoef(programs.T)
+    assert np.all(corr[np.triu_indices(20, 1)] <= 0.5)
+
+
+def test_simulate_lineage_workers_agree_and_warn(make_tree):
+    tree = make_tree(genes=30, seed=2, modules=50)
+    reference = None
+    for workers, backend in [(1, "process"), (2, "process"), (2, "thread")]:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            result = sim.simulate_lineage(tree, seed=3, workers=workers,
+                                          backend=backend, diagnostics=True,
+                                          a=0.05)
+        messages = [str(w.message) for w in caught
+                    if issubclass(w.category, RuntimeWarning)]
+        # one warning for the whole tree that names the degraded branches
+        assert len(messages) == 1
+        degraded = [b for b, stats in result[3].programs.items()
+                    if stats.exhausted]
+        assert degraded
+        for branch in degraded:
+            assert branch in messages[0]
+
+        # the scheduling does not change the simulated lineage
+        if reference is None:
+            reference = result
+            continue
+        npt.assert_array_equal(result[2], reference[2])
+        for branch in tree.branches:
+            npt.assert_array_equal(result[0][branch], reference[0][branch])
+            npt.assert_array_equal(result[1][branch], reference[1][branch])
+
+
+def test_simulate_lineage_branch_budget(make_tree):
+    tree = make_tree(genes=30, seed=4, modules=10)
+    # no candidate can stay below a negative cutoff
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        result = sim.simulate_lineage(tree, rel_exp_cutoff=-1., seed=5,
+                                      max_branch_attempts=3, diagnostics=True,
+                                      a=0.05)
+    for branch in tree.branches:
+        stats = result[3].branches[branch]
+        assert stats.exhausted
+        assert stats.attempts == 3
+        assert stats.failures["cutoff"] == 3
+        assert result[0][branch].shape == (tree.time[branch], tree.G)
+    assert any("ran out of candidates" in str(w.message) for w in caught)
+
+    npt.assert_raises(RuntimeError, sim.simulate_lineage, tree,
+                      rel_exp_cutoff=-1., seed=5, max_branch_attempts=3,
+                      fallback="raise", a=0.05)
+
+
+def test_sibling_group_tests_only_the_new_sibling():
+    rng = np.random.default_rng(0)
+    coefficients = rng.gamma(0.5, size=(10, 40))
+    seeds = np.random.SeedSequence(3).spawn(3)
+    programs, rel_means, stats, _ = sim._simulate_sibling_group(
+        ["B", "C", "D"], None, [20, 20, 20], seeds, coefficients, 10, 40,
+        100., 0.5, 0.5, max_branch_attempts=4)
+    # C ran out of candidates and does not diverge from B ...
+    assert stats["C"].exhausted
+    assert sut.divergence_from("C", ["B"], rel_means, 40)[0] <= 0.5
+    # ... which does not stop D from diverging from both
+    assert not stats["D"].exhausted
+    assert stats["D"].attempts == 1
+    assert np.all(sut.divergence_from("D", ["B", "C"], rel_means, 40) > 0.5)
+
+
+def test_lazy_means_match_materialized(make_tree):
+    tree = make_tree(genes=40, seed=6)
+    tree.default_gene_expression(lazy=True)
+    lazy = tree.means
+    rows = np.random.randint(0, 115, size=500)
+    materialized = tu.BranchMeans.pack(lazy, tree.branches)
+    npt.assert_allclose(lazy.take(rows, block_size=7), materialized.take(rows),
+                        rtol=1e-12)
+    npt.assert_allclose(lazy.take(rows), materialized.take(rows), rtol=1e-12)
+    for branch in tree.branches:
+        npt.assert_allclose(lazy[branch], materialized[branch], rtol=1e-12)
+
+    dense = sim.sample_density(tree, 300, seed=1, chunk_size=64)[0]
+    tree.means = materialized
+    npt.assert_array_equal(sim.sample_density(tree, 300, seed=1,
+                                              chunk_size=64)[0], dense)
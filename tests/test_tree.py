@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Tests of prosstt.tree: the read-only views returned by the structural
+queries and the invalidation of their cache.
+"""
+
+import pickle
+from collections import defaultdict
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+
+def test_query_types(make_tree):
+    tree = make_tree()
+    treedict = tree.as_dictionary()
+    assert treedict["A"] == ("B", "C")
+    # missing branches are leaves
+    assert treedict["D"] == ()
+    assert "D" not in treedict
+    assert tree.paths("A") == (("A", "B", "D"), ("A", "B", "E"), ("A", "C"))
+    times = tree.branch_times()
+    assert isinstance(times, defaultdict)
+    assert times["B"] == [35, 84]
+    assert all(isinstance(zone, list) for zone in tree.populate_timezone())
+    assert isinstance(tree.topology, tuple)
+    assert all(isinstance(pair, tuple) for pair in tree.topology)
+    assert tree.density.keys() == set(tree.branches)
+
+
+def test_read_only_views_raise_on_mutation(make_tree):
+    tree = make_tree()
+    with pytest.raises(AttributeError):
+        tree.paths("A").append(("X",))
+    with pytest.raises(TypeError):
+        tree.as_dictionary()["A"] = ("X",)
+    with pytest.raises(AttributeError):
+        tree.topology.append(("C", "X"))
+    with pytest.raises(ValueError):
+        tree.time["A"] = 1
+    with pytest.raises(TypeError):
+        tree.density["A"] = np.zeros(35)
+    with pytest.raises(ValueError):
+        tree.density["A"][:] = 0
+    with pytest.raises(TypeError):
+        tree.get_parallel_branches()["A"] = ["X"]
+    with pytest.raises(ValueError):
+        tree.get_parallel_branches()["A"][0] = "X"
+    # branch_times still hands out a copy
+    tree.branch_times()["B"][0] = -1
+
+    fresh = make_tree()
+    assert tree.paths("A") == fresh.paths("A")
+    assert tree.as_dictionary() == fresh.as_dictionary()
+    assert tree.branch_times() == fresh.branch_times()
+    assert tree.topology == fresh.topology
+    assert tree.time.equals(fresh.time)
+    npt.assert_array_equal(tree.density["A"], fresh.density["A"])
+    npt.assert_array_equal(tree.get_parallel_branches()["A"], ["B", "C"])
+
+
+def test_assignment_clears_the_cache(make_tree):
+    tree = make_tree()
+    assert tree.branch_times()["C"] == [35, 74]
+    time = tree.time.copy()
+    time["A"] = 10
+    tree.time = time
+    assert tree.branch_times()["C"] == [10, 49]
+    assert tree.get_max_time() == 10 + 50 + 30
+
+    tree.topology = [["A", "C"], ["A", "B"], ["B", "D"], ["B", "E"]]
+    assert tree.paths("A") == (("A", "C"), ("A", "B", "D"), ("A", "B", "E"))
+
+    tree = make_tree()
+    tree.density_sampler()
+    density = dict(tree.density)
+    density["C"] = np.zeros_like(density["C"])
+    tree.density = density
+    _, branches = tree.density_sampler().sample(1000, np.random.default_rng(0))
+    assert "C" not in set(branches)
+
+
+def test_pickle_round_trip(make_tree):
+    tree = make_tree()
+    tree.branch_times()
+    tree.density_sampler()
+    clone = pickle.loads(pickle.dumps(tree))
+    assert clone.branch_times() == tree.branch_times()
+    npt.assert_array_equal(clone.density["D"], tree.density["D"])
+    for arr in clone.density.values():
+        assert not arr.flags.writeable
+    with pytest.raises(ValueError):
+        clone.time["A"] = 1